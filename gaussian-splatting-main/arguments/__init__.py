@@ -56,6 +56,9 @@ class ModelParams(ParamGroup):
         self.train_test_exp = False
         self.data_device = "cuda"
         self.eval = False
+        self.save_compressed = False
+        self.compressed_positions = "float32"
+        self.spatial_order = ""
         super().__init__(parser, "Loading Parameters", sentinel)
 
     def extract(self, args):
@@ -17,6 +17,11 @@ from scene.dataset_readers import sceneLoadTypeCallbacks
 from scene.gaussian_model import GaussianModel
 from arguments import ModelParams
 from utils.camera_utils import cameraList_from_camInfos, camera_to_JSON
+from utils.compression_utils import COMPRESSED_POSITIONS
+from utils.spatial_utils import SPATIAL_CURVES
+
+# Quantized copy of the point cloud written next to point_cloud.ply with --save_compressed
+COMPRESSED_POINT_CLOUD = "point_cloud_compressed.npz"
 
 class Scene:
 
@@ -27,6 +32,14 @@ class Scene:
         :param path: Path to colmap scene main folder.
         """
         self.model_path = args.model_path
+        self.save_compressed = args.save_compressed
+        if args.compressed_positions not in COMPRESSED_POSITIONS:
+            raise ValueError("Unknown compressed positions {}, expected one of {}".format(args.compressed_positions, list(COMPRESSED_POSITIONS)))
+        self.compressed_positions = args.compressed_positions
+        # Checked here rather than at the first save, possibly hours into training
+        if args.spatial_order and args.spatial_order not in SPATIAL_CURVES:
+            raise ValueError("Unknown space filling curve {}, expected one of {}".format(args.spatial_order, list(SPATIAL_CURVES)))
+        self.spatial_order = args.spatial_order
         self.loaded_iter = None
         self.gaussians = gaussians
 
@@ -75,16 +88,21 @@ class Scene:
             self.test_cameras[resolution_scale] = cameraList_from_camInfos(scene_info.test_cameras, resolution_scale, args, scene_info.is_nerf_synthetic, True)
 
         if self.loaded_iter:
-            self.gaussians.load_ply(os.path.join(self.model_path,
-                                                           "point_cloud",
-                                                           "iteration_" + str(self.loaded_iter),
-                                                           "point_cloud.ply"), args.train_test_exp)
+            point_cloud_path = os.path.join(self.model_path, "point_cloud", "iteration_" + str(self.loaded_iter))
+            if not os.path.exists(os.path.join(point_cloud_path, "point_cloud.ply")) and \
+                    os.path.exists(os.path.join(point_cloud_path, COMPRESSED_POINT_CLOUD)):
+                # Deployed models may only ship the compressed point cloud
+                self.gaussians.load_compressed(os.path.join(point_cloud_path, COMPRESSED_POINT_CLOUD), args.train_test_exp)
+            else:
+                self.gaussians.load_ply(os.path.join(point_cloud_path, "point_cloud.ply"), args.train_test_exp)
         else:
             self.gaussians.create_from_pcd(scene_info.point_cloud, scene_info.train_cameras, self.cameras_extent)
 
     def save(self, iteration):
         point_cloud_path = os.path.join(self.model_path, "point_cloud/iteration_{}".format(iteration))
-        self.gaussians.save_ply(os.path.join(point_cloud_path, "point_cloud.ply"))
+        self.gaussians.save_ply(os.path.join(point_cloud_path, "point_cloud.ply"), self.spatial_order)
+        if self.save_compressed:
+            self.gaussians.save_compressed(os.path.join(point_cloud_path, COMPRESSED_POINT_CLOUD), morton=self.compressed_positions == 'morton16')
         exposure_dict = {
             image_name: self.gaussians.get_exposure_from_name(image_name).detach().cpu().numpy().tolist()
             for image_name in self.gaussians.exposure_mapping
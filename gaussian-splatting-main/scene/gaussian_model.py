@@ -16,7 +16,9 @@ from torch import nn
 import os
 import json
 from utils.system_utils import mkdir_p
-from plyfile import PlyData, PlyElement
+from utils.ply_utils import structured_from_columns, write_ply, read_ply, gather_columns
+from utils.compression_utils import save_compressed_gaussians, load_compressed_gaussians
+from utils.spatial_utils import spatial_order
 from utils.sh_utils import RGB2SH
 from simple_knn._C import distCUDA2
 from utils.graphics_utils import BasicPointCloud
@@ -236,32 +238,45 @@ class GaussianModel:
             l.append('rot_{}'.format(i))
         return l
 
-    def save_ply(self, path):
-        mkdir_p(os.path.dirname(path))
-
+    def get_ply_attributes(self):
+        # Per-Gaussian attributes as [N, k] float32 arrays, in the order and layout of the PLY properties
         xyz = self._xyz.detach().cpu().numpy()
-        normals = np.zeros_like(xyz)
         f_dc = self._features_dc.detach().transpose(1, 2).flatten(start_dim=1).contiguous().cpu().numpy()
         f_rest = self._features_rest.detach().transpose(1, 2).flatten(start_dim=1).contiguous().cpu().numpy()
         opacities = self._opacity.detach().cpu().numpy()
         scale = self._scaling.detach().cpu().numpy()
         rotation = self._rotation.detach().cpu().numpy()
+        return xyz, f_dc, f_rest, opacities, scale, rotation
+
+    def save_ply(self, path, curve=""):
+        mkdir_p(os.path.dirname(path))
+
+        xyz, f_dc, f_rest, opacities, scale, rotation = self.get_ply_attributes()
+        if curve:
+            # Written sorted along the space filling curve, the model itself is left as is
+            order = spatial_order(xyz, curve)
+            xyz, f_dc, f_rest, opacities, scale, rotation = (
+                attribute[order] for attribute in (xyz, f_dc, f_rest, opacities, scale, rotation))
+        normals = np.zeros_like(xyz)
 
         dtype_full = [(attribute, 'f4') for attribute in self.construct_list_of_attributes()]
 
-        elements = np.empty(xyz.shape[0], dtype=dtype_full)
         attributes = np.concatenate((xyz, normals, f_dc, f_rest, opacities, scale, rotation), axis=1)
-        elements[:] = list(map(tuple, attributes))
-        el = PlyElement.describe(elements, 'vertex')
-        PlyData([el]).write(path)
+        # Every property is a float32, so the records are a view of the rows of the matrix
+        elements = structured_from_columns(attributes, dtype_full)
+        write_ply(path, elements)
+
+    def save_compressed(self, path, morton=True):
+        # Quantized container for deployment (see utils/compression_utils.py), lossy
+        mkdir_p(os.path.dirname(path))
+        save_compressed_gaussians(path, *self.get_ply_attributes(), morton=morton)
 
     def reset_opacity(self):
         opacities_new = self.inverse_opacity_activation(torch.min(self.get_opacity, torch.ones_like(self.get_opacity)*0.01))
         optimizable_tensors = self.replace_tensor_to_optimizer(opacities_new, "opacity")
         self._opacity = optimizable_tensors["opacity"]
 
-    def load_ply(self, path, use_train_test_exp = False):
-        plydata = PlyData.read(path)
+    def load_exposures(self, path, use_train_test_exp):
         if use_train_test_exp:
             exposure_file = os.path.join(os.path.dirname(path), os.pardir, os.pardir, "exposure.json")
             if os.path.exists(exposure_file):
@@ -273,43 +288,50 @@ class GaussianModel:
                 print(f"No exposure to be loaded at {exposure_file}")
                 self.pretrained_exposures = None
 
-        xyz = np.stack((np.asarray(plydata.elements[0]["x"]),
-                        np.asarray(plydata.elements[0]["y"]),
-                        np.asarray(plydata.elements[0]["z"])),  axis=1)
-        opacities = np.asarray(plydata.elements[0]["opacity"])[..., np.newaxis]
+    def load_ply(self, path, use_train_test_exp = False):
+        # Memory mapped for binary little endian files, the columns are only read once below
+        vertices = read_ply(path)
+        self.load_exposures(path, use_train_test_exp)
+
+        xyz = gather_columns(vertices, ["x", "y", "z"], np.float32)
+        opacities = gather_columns(vertices, ["opacity"], np.float32)
 
-        features_dc = np.zeros((xyz.shape[0], 3, 1))
-        features_dc[:, 0, 0] = np.asarray(plydata.elements[0]["f_dc_0"])
-        features_dc[:, 1, 0] = np.asarray(plydata.elements[0]["f_dc_1"])
-        features_dc[:, 2, 0] = np.asarray(plydata.elements[0]["f_dc_2"])
+        features_dc = gather_columns(vertices, ["f_dc_0", "f_dc_1", "f_dc_2"], np.float32)[..., np.newaxis]
 
-        extra_f_names = [p.name for p in plydata.elements[0].properties if p.name.startswith("f_rest_")]
+        extra_f_names = [name for name in vertices.dtype.names if name.startswith("f_rest_")]
         extra_f_names = sorted(extra_f_names, key = lambda x: int(x.split('_')[-1]))
         assert len(extra_f_names)==3*(self.max_sh_degree + 1) ** 2 - 3
-        features_extra = np.zeros((xyz.shape[0], len(extra_f_names)))
-        for idx, attr_name in enumerate(extra_f_names):
-            features_extra[:, idx] = np.asarray(plydata.elements[0][attr_name])
+        features_extra = gather_columns(vertices, extra_f_names, np.float32)
         # Reshape (P,F*SH_coeffs) to (P, F, SH_coeffs except DC)
         features_extra = features_extra.reshape((features_extra.shape[0], 3, (self.max_sh_degree + 1) ** 2 - 1))
 
-        scale_names = [p.name for p in plydata.elements[0].properties if p.name.startswith("scale_")]
+        scale_names = [name for name in vertices.dtype.names if name.startswith("scale_")]
         scale_names = sorted(scale_names, key = lambda x: int(x.split('_')[-1]))
-        scales = np.zeros((xyz.shape[0], len(scale_names)))
-        for idx, attr_name in enumerate(scale_names):
-            scales[:, idx] = np.asarray(plydata.elements[0][attr_name])
+        scales = gather_columns(vertices, scale_names, np.float32)
 
-        rot_names = [p.name for p in plydata.elements[0].properties if p.name.startswith("rot")]
+        rot_names = [name for name in vertices.dtype.names if name.startswith("rot")]
         rot_names = sorted(rot_names, key = lambda x: int(x.split('_')[-1]))
-        rots = np.zeros((xyz.shape[0], len(rot_names)))
-        for idx, attr_name in enumerate(rot_names):
-            rots[:, idx] = np.asarray(plydata.elements[0][attr_name])
-
-        self._xyz = nn.Parameter(torch.tensor(xyz, dtype=torch.float, device="cuda").requires_grad_(True))
-        self._features_dc = nn.Parameter(torch.tensor(features_dc, dtype=torch.float, device="cuda").transpose(1, 2).contiguous().requires_grad_(True))
-        self._features_rest = nn.Parameter(torch.tensor(features_extra, dtype=torch.float, device="cuda").transpose(1, 2).contiguous().requires_grad_(True))
-        self._opacity = nn.Parameter(torch.tensor(opacities, dtype=torch.float, device="cuda").requires_grad_(True))
-        self._scaling = nn.Parameter(torch.tensor(scales, dtype=torch.float, device="cuda").requires_grad_(True))
-        self._rotation = nn.Parameter(torch.tensor(rots, dtype=torch.float, device="cuda").requires_grad_(True))
+        rots = gather_columns(vertices, rot_names, np.float32)
+        del vertices
+
+        self.set_attributes(xyz, features_dc, features_extra, opacities, scales, rots)
+
+    def load_compressed(self, path, use_train_test_exp = False):
+        self.load_exposures(path, use_train_test_exp)
+        xyz, f_dc, f_rest, opacities, scales, rots = load_compressed_gaussians(path)
+        assert f_rest.shape[1]==3*(self.max_sh_degree + 1) ** 2 - 3
+        features_dc = f_dc[..., np.newaxis]
+        features_extra = f_rest.reshape((f_rest.shape[0], 3, (self.max_sh_degree + 1) ** 2 - 1))
+        self.set_attributes(xyz, features_dc, features_extra, opacities, scales, rots)
+
+    def set_attributes(self, xyz, features_dc, features_extra, opacities, scales, rots):
+        # The arrays are already float32, from_numpy avoids another host copy before the upload
+        self._xyz = nn.Parameter(torch.from_numpy(xyz).cuda().requires_grad_(True))
+        self._features_dc = nn.Parameter(torch.from_numpy(features_dc).cuda().transpose(1, 2).contiguous().requires_grad_(True))
+        self._features_rest = nn.Parameter(torch.from_numpy(features_extra).cuda().transpose(1, 2).contiguous().requires_grad_(True))
+        self._opacity = nn.Parameter(torch.from_numpy(opacities).cuda().requires_grad_(True))
+        self._scaling = nn.Parameter(torch.from_numpy(scales).cuda().requires_grad_(True))
+        self._rotation = nn.Parameter(torch.from_numpy(rots).cuda().requires_grad_(True))
 
         self.active_sh_degree = self.max_sh_degree
 
@@ -346,6 +368,33 @@ class GaussianModel:
                 optimizable_tensors[group["name"]] = group["params"][0]
         return optimizable_tensors
 
+    def reorder(self, curve="morton"):
+        # Sort the Gaussians along a space filling curve of their positions (see utils/spatial_utils.py)
+        # so that nearby Gaussians are also nearby in memory. The optimizer state and the densification
+        # statistics are permuted with them, training can go on. Gradients are not, call it between
+        # an optimizer step and the next backward pass
+        order = torch.from_numpy(spatial_order(self._xyz.detach().cpu().numpy(), curve)).to(self._xyz.device)
+        if self.optimizer is not None:
+            optimizable_tensors = self._prune_optimizer(order)
+        else:
+            optimizable_tensors = {name: nn.Parameter(tensor[order].requires_grad_(True)) for name, tensor in (
+                ("xyz", self._xyz), ("f_dc", self._features_dc), ("f_rest", self._features_rest),
+                ("opacity", self._opacity), ("scaling", self._scaling), ("rotation", self._rotation))}
+
+        self._xyz = optimizable_tensors["xyz"]
+        self._features_dc = optimizable_tensors["f_dc"]
+        self._features_rest = optimizable_tensors["f_rest"]
+        self._opacity = optimizable_tensors["opacity"]
+        self._scaling = optimizable_tensors["scaling"]
+        self._rotation = optimizable_tensors["rotation"]
+
+        # Only allocated once training is set up
+        if self.xyz_gradient_accum.shape[0] == order.shape[0]:
+            self.xyz_gradient_accum = self.xyz_gradient_accum[order]
+            self.denom = self.denom[order]
+        if self.max_radii2D.shape[0] == order.shape[0]:
+            self.max_radii2D = self.max_radii2D[order]
+
     def prune_points(self, mask):
         valid_points_mask = ~mask
         optimizable_tensors = self._prune_optimizer(valid_points_mask)
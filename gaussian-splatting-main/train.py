@@ -185,6 +185,11 @@ def training(dataset, opt, pipe, testing_iterations, saving_iterations, checkpoi
                     gaussians.optimizer.step()
                     gaussians.optimizer.zero_grad(set_to_none = True)
 
+            # Keep training in the sorted order the Gaussians were just saved in. Not done in scene.save,
+            # the densification statistics of this iteration are indexed in the previous order
+            if (iteration in saving_iterations) and dataset.spatial_order:
+                gaussians.reorder(dataset.spatial_order)
+
             if (iteration in checkpoint_iterations):
                 print("\n[ITER {}] Saving Checkpoint".format(iteration))
                 torch.save((gaussians.capture(), iteration), scene.model_path + "/chkpnt" + str(iteration) + ".pth")
@@ -0,0 +1,92 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+# Compact container for trained Gaussians, meant for deployment rather than for resuming
+# training. It is a deflated .npz archive with the attributes in the PLY layout, quantized:
+#
+#   xyz        float32 [N, 3], or with Morton encoding uint16 grid coordinates over the
+#              bounding box (xyz_grid, xyz_min, xyz_step), the Gaussians being sorted along
+#              the Morton curve
+#   f_dc       float16 [N, 3]
+#   f_rest     uint8 [N, 3 * (SH - 1)], with a float32 offset and scale per channel
+#   opacity    float16 [N, 1]
+#   scale      float16 [N, 3]
+#   rotation   int8 [N, 4], normalized quaternion * 127
+#
+# For SH degree 3 that is 69 bytes per Gaussian (75 without Morton encoding) instead of 236,
+# before deflate.
+
+import numpy as np
+from utils.spatial_utils import morton_order, quantize_positions
+
+COMPRESSED_VERSION = 1
+POSITION_BITS = 16
+# Encodings of the positions: lossless float32, or Morton ordered 16 bit grid coordinates
+COMPRESSED_POSITIONS = ('float32', 'morton16')
+
+def compress_gaussians(xyz, f_dc, f_rest, opacity, scale, rotation, morton=True):
+    # Quantize attributes in the PLY layout ([N, k] float arrays) into the arrays of the container
+    arrays = {"version": np.array(COMPRESSED_VERSION)}
+    if morton:
+        order = morton_order(xyz, POSITION_BITS)
+        xyz, f_dc, f_rest, opacity, scale, rotation = (
+            attribute[order] for attribute in (xyz, f_dc, f_rest, opacity, scale, rotation))
+        grid, xyz_min, xyz_step = quantize_positions(xyz, POSITION_BITS)
+        arrays["xyz_grid"] = grid.astype(np.uint16)
+        arrays["xyz_min"] = xyz_min
+        arrays["xyz_step"] = xyz_step
+    else:
+        arrays["xyz"] = np.asarray(xyz, dtype=np.float32)
+
+    arrays["f_dc"] = np.asarray(f_dc, dtype=np.float16)
+
+    # 8 bits per SH coefficient, over the range of each channel
+    f_rest_min = f_rest.min(axis=0) if len(f_rest) else np.zeros(f_rest.shape[1])
+    f_rest_range = (f_rest.max(axis=0) - f_rest_min) if len(f_rest) else np.zeros(f_rest.shape[1])
+    f_rest_scale = np.where(f_rest_range > 0, f_rest_range / 255, 1.0).astype(np.float32)
+    arrays["f_rest"] = np.clip(np.rint((f_rest - f_rest_min) / f_rest_scale), 0, 255).astype(np.uint8)
+    arrays["f_rest_min"] = f_rest_min.astype(np.float32)
+    arrays["f_rest_scale"] = f_rest_scale
+
+    arrays["opacity"] = np.asarray(opacity, dtype=np.float16)
+    arrays["scale"] = np.asarray(scale, dtype=np.float16)
+
+    norm = np.linalg.norm(rotation, axis=1, keepdims=True)
+    rotation = rotation / np.where(norm > 0, norm, 1.0)
+    arrays["rotation"] = np.clip(np.rint(rotation * 127), -127, 127).astype(np.int8)
+    return arrays
+
+def decompress_gaussians(arrays):
+    # Dequantize the arrays of the container back to float32 attributes in the PLY layout:
+    # xyz, f_dc, f_rest, opacity, scale, rotation
+    if int(arrays["version"]) != COMPRESSED_VERSION:
+        raise ValueError("Unsupported compressed Gaussians version {}".format(int(arrays["version"])))
+
+    if "xyz_grid" in arrays:
+        xyz = (arrays["xyz_grid"] * arrays["xyz_step"] + arrays["xyz_min"]).astype(np.float32)
+    else:
+        xyz = arrays["xyz"].astype(np.float32)
+    f_dc = arrays["f_dc"].astype(np.float32)
+    f_rest = arrays["f_rest"] * arrays["f_rest_scale"] + arrays["f_rest_min"]
+    opacity = arrays["opacity"].astype(np.float32)
+    scale = arrays["scale"].astype(np.float32)
+    rotation = arrays["rotation"].astype(np.float32) / 127
+    return xyz, f_dc, f_rest.astype(np.float32), opacity, scale, rotation
+
+def save_compressed_gaussians(path, xyz, f_dc, f_rest, opacity, scale, rotation, morton=True):
+    arrays = compress_gaussians(xyz, f_dc, f_rest, opacity, scale, rotation, morton)
+    # Through a file object, np.savez would otherwise append .npz to the path
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+
+def load_compressed_gaussians(path):
+    with np.load(path) as archive:
+        return decompress_gaussians({name: archive[name] for name in archive.files})
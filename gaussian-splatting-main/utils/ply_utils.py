@@ -0,0 +1,128 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import numpy as np
+
+# numpy dtype -> PLY property type
+PLY_TYPES = {
+    'i1': 'char', 'u1': 'uchar',
+    'i2': 'short', 'u2': 'ushort',
+    'i4': 'int', 'u4': 'uint',
+    'f4': 'float', 'f8': 'double',
+}
+
+def structured_from_columns(attributes, dtype):
+    # Build the records of a structured array from a [N, n_fields] matrix without going
+    # through one Python tuple per row. When every field has the dtype of the matrix the
+    # records are a view of its rows, otherwise the fields are filled column by column.
+    dtype = np.dtype(dtype)
+    field_types = {dtype.fields[name][0] for name in dtype.names}
+    if len(field_types) == 1 and dtype.itemsize == attributes.shape[1] * attributes.itemsize \
+            and field_types == {attributes.dtype}:
+        return np.ascontiguousarray(attributes).view(dtype).reshape(-1)
+
+    elements = np.empty(attributes.shape[0], dtype=dtype)
+    for idx, name in enumerate(dtype.names):
+        elements[name] = attributes[:, idx]
+    return elements
+
+def write_ply(path, elements, element_name='vertex'):
+    # Write a structured array as a binary little endian PLY: the header, then the whole
+    # body in a single write
+    elements = np.ascontiguousarray(elements, dtype=elements.dtype.newbyteorder('<'))
+    header = ['ply', 'format binary_little_endian 1.0', 'element {} {}'.format(element_name, len(elements))]
+    for name in elements.dtype.names:
+        field_type = elements.dtype.fields[name][0]
+        header.append('property {} {}'.format(PLY_TYPES[field_type.str[1:]], name))
+    header.append('end_header')
+
+    with open(path, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        elements.tofile(f)
+
+# PLY property type (and its sized alias) -> numpy dtype
+PLY_DTYPES = dict([(ply_type, dtype) for dtype, ply_type in PLY_TYPES.items()] + [
+    ('int8', 'i1'), ('uint8', 'u1'),
+    ('int16', 'i2'), ('uint16', 'u2'),
+    ('int32', 'i4'), ('uint32', 'u4'),
+    ('float32', 'f4'), ('float64', 'f8'),
+])
+
+def read_ply_header(f):
+    # Parse the header of an open PLY file. Returns the format and a list of
+    # (element name, count, properties), a property being (name, numpy type) or None for
+    # list properties, and leaves the file at the start of the body
+    if f.readline().strip() != b'ply':
+        raise ValueError("Not a PLY file")
+    ply_format = None
+    elements = []
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError("PLY header has no end_header")
+        words = line.decode('ascii').split()
+        if not words or words[0] in ('comment', 'obj_info'):
+            continue
+        if words[0] == 'end_header':
+            return ply_format, elements
+        if words[0] == 'format':
+            ply_format = words[1]
+        elif words[0] == 'element':
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == 'property':
+            if words[1] == 'list':
+                elements[-1][2].append(None)
+            else:
+                elements[-1][2].append((words[2], PLY_DTYPES[words[1]]))
+
+def read_ply(path, element_name='vertex'):
+    # Read one element of a PLY file as a structured array. For binary little endian files
+    # whose elements up to this one have no list properties, the records are memory mapped
+    # straight from the file (read-only) instead of being parsed by plyfile
+    with open(path, 'rb') as f:
+        ply_format, elements = read_ply_header(f)
+        offset = f.tell()
+
+    if ply_format == 'binary_little_endian':
+        for name, count, properties in elements:
+            if None in properties:
+                break
+            dtype = np.dtype([(property_name, '<' + property_type) for property_name, property_type in properties])
+            if name == element_name:
+                if count == 0:
+                    return np.empty(0, dtype=dtype)
+                return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+            offset += count * dtype.itemsize
+
+    from plyfile import PlyData
+    return PlyData.read(path)[element_name].data
+
+def gather_columns(elements, names, dtype=None):
+    # Gather fields of a structured array into a [N, len(names)] matrix (of the common type of
+    # the fields by default). Consecutive fields of the same type, e.g. all the f_rest_* of a
+    # Gaussian, are copied in one strided pass
+    field_dtypes = [elements.dtype.fields[name][0] for name in names]
+    offsets = [elements.dtype.fields[name][1] for name in names]
+    dtype = np.dtype(dtype or np.result_type(*field_dtypes))
+    if len(elements) == 0:
+        return np.empty((0, len(names)), dtype=dtype)
+    field_dtype = field_dtypes[0]
+    consecutive = all(field == field_dtype for field in field_dtypes) and \
+        all(offsets[i] == offsets[0] + i * field_dtype.itemsize for i in range(len(names)))
+    if consecutive and elements.strides[0] == elements.dtype.itemsize:
+        columns = np.ndarray((len(elements), len(names)), dtype=field_dtype, buffer=elements,
+                             offset=offsets[0], strides=(elements.dtype.itemsize, field_dtype.itemsize))
+        return columns.astype(dtype)
+
+    matrix = np.empty((len(elements), len(names)), dtype=dtype)
+    for idx, name in enumerate(names):
+        matrix[:, idx] = elements[name]
+    return matrix
@@ -0,0 +1,87 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import numpy as np
+
+def quantize_positions(xyz, bits=16):
+    # Map positions [N, 3] to integer grid coordinates of "bits" bits per axis over their
+    # bounding box. Returns the coordinates (uint64), the box minimum and the grid step
+    xyz = np.asarray(xyz, dtype=np.float64)
+    xyz_min = xyz.min(axis=0) if len(xyz) else np.zeros(3)
+    extent = (xyz.max(axis=0) - xyz_min) if len(xyz) else np.zeros(3)
+    levels = (1 << bits) - 1
+    step = np.where(extent > 0, extent / levels, 1.0)
+    grid = np.clip(np.rint((xyz - xyz_min) / step), 0, levels).astype(np.uint64)
+    return grid, xyz_min, step
+
+def _part1by2(x):
+    # Spread the low 21 bits of x so that there are two zero bits between consecutive bits
+    x = x & np.uint64(0x1fffff)
+    x = (x | (x << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+    x = (x | (x << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+    x = (x | (x << np.uint64(8))) & np.uint64(0x100f00f00f00f00f)
+    x = (x | (x << np.uint64(4))) & np.uint64(0x10c30c30c30c30c3)
+    x = (x | (x << np.uint64(2))) & np.uint64(0x1249249249249249)
+    return x
+
+def morton_codes(xyz, bits=16):
+    # 3D Morton (Z-order) code of every position, on a grid of "bits" (at most 21) bits per axis
+    grid, _, _ = quantize_positions(xyz, bits)
+    return _part1by2(grid[:, 0]) | (_part1by2(grid[:, 1]) << np.uint64(1)) | (_part1by2(grid[:, 2]) << np.uint64(2))
+
+def hilbert_codes(xyz, bits=16):
+    # 3D Hilbert curve index of every position, on a grid of "bits" (at most 21) bits per axis.
+    # Skilling's transform ("Programming the Hilbert curve", 2004), vectorized over the points:
+    # the grid coordinates are turned into the transposed Hilbert index, whose bits are then
+    # interleaved as for a Morton code
+    grid, _, _ = quantize_positions(xyz, bits)
+    x = [grid[:, i].copy() for i in range(3)]
+
+    # Inverse undo
+    q = np.uint64(1 << (bits - 1))
+    while q > 1:
+        p = q - np.uint64(1)
+        for i in range(3):
+            bit_set = (x[i] & q) != 0
+            if i == 0:
+                x[0] = np.where(bit_set, x[0] ^ p, x[0])
+                continue
+            # Invert the low bits of x[0] if the bit is set, otherwise exchange them with those of x[i]
+            t = (x[0] ^ x[i]) & p
+            x[0] = np.where(bit_set, x[0] ^ p, x[0] ^ t)
+            x[i] = np.where(bit_set, x[i], x[i] ^ t)
+        q >>= np.uint64(1)
+
+    # Gray encode
+    x[1] ^= x[0]
+    x[2] ^= x[1]
+    t = np.zeros_like(x[0])
+    q = np.uint64(1 << (bits - 1))
+    while q > 1:
+        t = np.where((x[2] & q) != 0, t ^ (q - np.uint64(1)), t)
+        q >>= np.uint64(1)
+    for i in range(3):
+        x[i] ^= t
+
+    return (_part1by2(x[0]) << np.uint64(2)) | (_part1by2(x[1]) << np.uint64(1)) | _part1by2(x[2])
+
+# Space filling curves available to spatial_order
+SPATIAL_CURVES = {'morton': morton_codes, 'hilbert': hilbert_codes}
+
+def morton_order(xyz, bits=16):
+    # Permutation sorting positions [N, 3] along the Morton curve
+    return np.argsort(morton_codes(xyz, bits), kind='stable')
+
+def spatial_order(xyz, curve='morton', bits=16):
+    # Permutation sorting positions [N, 3] along a space filling curve of SPATIAL_CURVES
+    if curve not in SPATIAL_CURVES:
+        raise ValueError("Unknown space filling curve {}, expected one of {}".format(curve, list(SPATIAL_CURVES)))
+    return np.argsort(SPATIAL_CURVES[curve](xyz, bits), kind='stable')
@@ -0,0 +1,259 @@
+"""Band power engine for several headsets and channels
+
+Keeps one raw EEG buffer per session (headset) and computes the band powers
+of every session and channel together: the newest epochs are stacked into a
+[sessions, channels, samples] array and transformed with a single FFT per tick.
+
+In incremental mode the band powers are instead updated with a sliding DFT as
+samples arrive, so the cost of a tick scales with the shift rather than with
+the epoch length. The DFT bins of every session are kept in one
+[bins, sessions, channels] array, and the new samples of all sessions slide it
+with a single matrix product per tick.
+"""
+
+import functools
+import time
+
+import numpy as np
+
+import utils
+
+# In incremental mode, the DFT of every session is recomputed from its epoch
+# every RESYNC_TICKS ticks, so that rounding errors do not accumulate
+RESYNC_TICKS = 1000
+
+
+@functools.lru_cache(maxsize=None)
+def get_sliding_twiddles(n_samples, n_bins, n_new):
+    """Twiddles sliding an N-sample DFT over n_new samples, for the DFT bins k
+
+    X_k <- (X_k + sum_s (x_new[s] - x_old[s]) * exp(-2j*pi*k*s/N)) * exp(2j*pi*k*n_new/N)
+
+    Returns:
+        (numpy.ndarray): exp(-2j*pi*k*s/N) for the new samples then minus it for
+            the old ones, shape [n_bins, 2 * n_new]
+        (numpy.ndarray): rotation exp(2j*pi*k*n_new/N), shape [n_bins, 1, 1]
+    """
+    k = np.arange(n_bins)[:, np.newaxis]
+    twiddles = np.exp(-2j * np.pi * k * np.arange(n_new) / n_samples)
+    rotation = np.exp(2j * np.pi * k * n_new / n_samples)
+    return np.concatenate((twiddles, -twiddles), axis=1), rotation[..., np.newaxis]
+
+
+class BandPowerEngine:
+    """Buffers raw EEG from N sessions x C channels and computes their band powers.
+
+    Args:
+        n_sessions (int): number of sessions (headsets)
+        fs (float): sampling frequency shared by all sessions
+        channels (list): index of the channel(s) kept from each incoming chunk
+        buffer_length (float): length of the raw EEG buffers (in seconds)
+        epoch_length (float): length of the epochs used to compute the FFT (in seconds)
+        n_smooth (int): number of band power ticks averaged by "smooth_band_powers"
+        notch (bool): filter incoming samples (see utils.FilterBank)
+        highpass (float): cutoff (in Hz) of the high-pass filter stage, None for no high-pass
+        n_harmonics (int): number of line-noise harmonics also stopped by the notch filter
+        incremental (bool): use sliding DFT band powers
+        psd_method (str): spectrum estimator of the band powers (see
+            utils.PSDMethod), the incremental mode only supports PSDMethod.FFT
+        latency (latency.LatencyStats): records the duration of the acquire,
+            filter and fft stages of every tick, None for no instrumentation
+    """
+
+    def __init__(
+        self,
+        n_sessions,
+        fs,
+        channels=(0,),
+        buffer_length=5,
+        epoch_length=1,
+        n_smooth=1,
+        notch=True,
+        highpass=None,
+        n_harmonics=0,
+        incremental=False,
+        psd_method=utils.PSDMethod.FFT,
+        latency=None,
+    ):
+        if incremental and psd_method != utils.PSDMethod.FFT:
+            raise ValueError(f"Incremental band powers only support the FFT PSD method, got {psd_method!r}")
+
+        self.n_sessions = n_sessions
+        self.fs = fs
+        self.channels = list(channels)
+        self.notch = notch
+        self.incremental = incremental
+        self.psd_method = psd_method
+        self.latency = latency
+        self.inlets = []
+        # Timestamp of the newest sample of every session, corrected to the
+        # local clock with the time correction of its inlet (nan before any sample)
+        self.sample_timestamps = np.full(n_sessions, np.nan)
+        self.time_corrections = np.zeros(n_sessions)
+        self.epoch_samples = int(epoch_length * fs)
+
+        n_channels = len(self.channels)
+        self.buffer_samples = int(fs * buffer_length)
+        # Every session buffer writes into its row of one array, so that samples
+        # of all sessions can be gathered at once (see "_slide")
+        self._eeg_data = np.zeros((n_sessions, 2 * self.buffer_samples, n_channels))
+        self.eeg_buffers = [
+            utils.RingBuffer(self.buffer_samples, n_channels, buffer=self._eeg_data[session])
+            for session in range(n_sessions)
+        ]
+        self.filter_states = [
+            utils.FilterBank(fs, n_harmonics=n_harmonics, highpass=highpass) if notch else None
+            for _ in range(n_sessions)
+        ]
+
+        # Newest epoch of every session, filled in place on each tick
+        self._epochs = np.zeros((n_sessions, n_channels, self.epoch_samples))
+
+        if incremental:
+            self.plan = utils.get_spectral_plan(self.epoch_samples, fs)
+            if self.plan.nfft != self.epoch_samples:
+                raise ValueError(f"Incremental band powers need a power of 2 epoch length, got {self.epoch_samples}")
+            # Only the DFT bins used by the bands, plus one for the window convolution of the last one
+            self.n_dft_bins = self.plan.n_bins + 1
+            # Bins first, so that sliding and windowing the DFT of every session are plain matrix products
+            self._dft = np.zeros((self.n_dft_bins, n_sessions, n_channels), dtype=complex)
+            # Offset removal and Hamming window in the frequency domain: X[0] = 0, then
+            # 0.54 X[k] - 0.23 (X[k - 1] + X[k + 1]), which corresponds to the periodic
+            # Hamming window (compute_band_powers_batch uses the symmetric one, results
+            # differ very slightly). Bin 0 is set apart, its X[-1] is conj(X[1])
+            self._window = np.zeros((self.plan.n_bins, self.n_dft_bins))
+            bins = np.arange(1, self.plan.n_bins)
+            self._window[bins, bins] = 0.54
+            self._window[bins, bins + 1] = -0.23
+            self._window[bins[1:], bins[1:] - 1] = -0.23
+            # Samples appended to every session since the last tick
+            self._n_pending = np.zeros(n_sessions, dtype=int)
+            self._ticks = 0
+            # Longer chunks are not slid over (the DFT is recomputed): the samples they push out
+            # of the epoch would overlap them, or no longer be buffered
+            self._max_slide = min(self.epoch_samples - 1, self.buffer_samples - self.epoch_samples)
+            self._sessions = np.arange(n_sessions)
+            # Rows of all session buffers, and the first one of each session in it
+            self._eeg_rows = self._eeg_data.reshape(-1, n_channels)
+            self._first_rows = self._sessions * 2 * self.buffer_samples
+            # Offsets of the new samples and of the samples leaving the epoch, from the end of the buffer
+            offsets = np.arange(self.epoch_samples)[:, np.newaxis]
+            self._offsets = np.stack((offsets, offsets - self.epoch_samples))  # [2, samples, 1]
+
+        # Band powers of every session, channel and band share one buffer
+        self.band_shape = (n_sessions, n_channels, 4)
+        self.band_buffer = utils.RingBuffer(n_smooth, int(np.prod(self.band_shape)))
+
+    @classmethod
+    def from_inlets(cls, inlets, fs, **kwargs):
+        """Create an engine with one session per inlet"""
+        engine = cls(len(inlets), fs, **kwargs)
+        engine.inlets = list(inlets)
+        engine.time_corrections[:] = [inlet.time_correction() for inlet in engine.inlets]
+        return engine
+
+    def pull(self, max_samples, timeout=1):
+        """Pull a chunk from every inlet and append it to its session buffer"""
+        acquire_time = filter_time = 0
+        for session, inlet in enumerate(self.inlets):
+            start = time.perf_counter()
+            eeg_data, timestamps = inlet.pull_chunk(timeout=timeout, max_samples=max_samples)
+            pulled = time.perf_counter()
+            if len(eeg_data):
+                self.sample_timestamps[session] = timestamps[-1] + self.time_corrections[session]
+                self.append(session, np.asarray(eeg_data))
+            acquire_time += pulled - start
+            filter_time += time.perf_counter() - pulled
+
+        if self.latency is not None:
+            self.latency.record("acquire", acquire_time)
+            self.latency.record("filter", filter_time)
+
+    def append(self, session, eeg_data):
+        """Append a raw chunk [n_samples, n_all_channels] to a session buffer"""
+        ch_data = eeg_data[:, self.channels]  # Only keep the channels we're interested in
+        self.eeg_buffers[session], self.filter_states[session] = utils.update_buffer(
+            self.eeg_buffers[session],
+            ch_data,
+            notch=self.notch,
+            filter_state=self.filter_states[session],
+            fs=self.fs,
+        )
+        if self.incremental:
+            self._n_pending[session] += ch_data.shape[0]
+
+    def _slide(self):
+        """Slide the DFT bins of every session over the samples appended since the last tick
+
+        The new (filtered) samples end each session buffer and the samples that
+        left the epoch are "epoch_samples" rows before them, so both are gathered
+        for all sessions at once, and sessions with the same number of new
+        samples are updated with a single matrix product.
+        """
+        n_pending = self._n_pending
+        # Row after the newest sample of every session
+        ends = self._first_rows + [eeg_buffer.end for eeg_buffer in self.eeg_buffers]
+
+        n_new = int(n_pending[0])
+        if 0 < n_new <= self._max_slide and (n_pending == n_new).all():
+            # Usual case, every session got a chunk of the same length
+            self._dft += self._slide_sum(ends, n_new)
+            self._dft *= get_sliding_twiddles(self.epoch_samples, self.n_dft_bins, n_new)[1]
+            resync = []
+        else:
+            slid = n_pending[(n_pending > 0) & (n_pending <= self._max_slide)]
+            for n_new in np.unique(slid).tolist():
+                group = np.flatnonzero(n_pending == n_new)
+                rotation = get_sliding_twiddles(self.epoch_samples, self.n_dft_bins, n_new)[1]
+                self._dft[:, group] = (self._dft[:, group] + self._slide_sum(ends[group], n_new)) * rotation
+            resync = np.flatnonzero(n_pending > self._max_slide)
+        n_pending.fill(0)
+
+        self._ticks += 1
+        if self._ticks % RESYNC_TICKS == 0:
+            resync = self._sessions
+        if len(resync):
+            # Recompute the DFT from the epoch
+            rows = ends[resync] - self.epoch_samples + self._offsets[0]
+            epochs = np.take(self._eeg_rows, rows, axis=0)  # [samples, sessions, channels]
+            self._dft[:, resync] = np.fft.rfft(epochs, axis=0)[: self.n_dft_bins]
+
+    def _slide_sum(self, ends, n_new):
+        """sum_s (x_new[s] - x_old[s]) * exp(-2j*pi*k*s/N) of the sessions whose buffers end at "ends",
+        shape [bins, sessions, channels]"""
+        twiddles = get_sliding_twiddles(self.epoch_samples, self.n_dft_bins, n_new)[0]
+        # New samples end the buffers, the ones that left the epoch are "epoch_samples" rows before
+        samples = np.take(self._eeg_rows, ends - n_new + self._offsets[:, :n_new], axis=0)
+        return (twiddles @ samples.reshape(2 * n_new, -1)).reshape((self.n_dft_bins, len(ends), -1))
+
+    def _sliding_band_powers(self):
+        """Log10 band powers from the DFT bins, shape [sessions, channels, 4]"""
+        dft = self._dft.reshape(self.n_dft_bins, -1)
+        windowed = self._window @ dft
+        windowed[0] = -0.46 * dft[1].real
+        band_powers = self.plan.band_matrix.T @ np.abs(windowed)  # [4, sessions * channels]
+        return np.log10(band_powers.T.reshape(self.band_shape))
+
+    def compute_band_powers(self):
+        """Compute the band powers of the newest epoch of every session and channel
+
+        Returns:
+            (numpy.ndarray): log10 band powers of shape [sessions, channels, 4]
+        """
+        start = time.perf_counter()
+        if self.incremental:
+            self._slide()
+            band_powers = self._sliding_band_powers()
+        else:
+            for session, eeg_buffer in enumerate(self.eeg_buffers):
+                self._epochs[session] = utils.get_last_data(eeg_buffer, self.epoch_samples).T
+
+            band_powers = utils.compute_band_powers_batch(self._epochs, self.fs, self.psd_method)
+        self.band_buffer.append(band_powers.reshape(1, -1))
+        if self.latency is not None:
+            self.latency.record("fft", time.perf_counter() - start)
+        return band_powers
+
+    def smooth_band_powers(self):
+        """Average of the band powers over the band buffer, shape [sessions, channels, 4]"""
+        return np.mean(self.band_buffer.data, axis=0).reshape(self.band_shape)
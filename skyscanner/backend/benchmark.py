@@ -0,0 +1,206 @@
+"""Benchmarks of the EEG backend pipeline
+
+Run with `python benchmark.py` (see --help). Every benchmark is fed with
+synthetic data from DemoInlet and reports the mean latency per call. The
+pipeline, band power and broadcast benchmarks are also run for 1, 10 and 100
+simultaneous sessions (or clients) and report ticks per second, the band power
+one also the speed-up of the incremental mode over the FFT one.
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+
+import numpy as np
+import websockets
+
+import utils
+from band_power_engine import BandPowerEngine
+from demo_inlet import DemoInlet
+from main import (
+    BUFFER_LENGTH,
+    EPOCH_LENGTH,
+    SHIFT_LENGTH,
+    calculate_extended_metrics,
+    calculate_extended_metrics_matrix,
+)
+from metrics_tracker import METRIC_NAMES, MetricsTracker
+from ws_server import WebSocketServer
+
+FS = 256
+SESSION_COUNTS = (1, 10, 100)
+
+
+def timeit(function, repeat, warmup=10):
+    """Mean duration of a call of "function" in seconds"""
+    for _ in range(warmup):
+        function()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def report(name, duration, ticks=None, baseline=None):
+    line = f"{name:<52} {duration * 1e6:>12.1f} us/call"
+    if ticks is not None:
+        line += f" {ticks / duration:>12.1f} ticks/s"
+    if baseline is not None:
+        line += f" {baseline / duration:>8.2f}x"
+    print(line)
+
+
+def demo_data(n_samples, n_channels=1, seed=0):
+    inlet = DemoInlet(FS, num_channels=n_channels, as_array=True, pace=False, seed=seed)
+    return inlet.pull_chunk(max_samples=n_samples)[0].copy()
+
+
+def bench_functions(repeat):
+    epoch = demo_data(int(EPOCH_LENGTH * FS), 4)
+    for method in (utils.PSDMethod.FFT, utils.PSDMethod.Welch, utils.PSDMethod.Multitaper):
+        report(
+            f"compute_band_powers [{method}, 1 s x 4 channels]",
+            timeit(lambda method=method: utils.compute_band_powers(epoch, FS, method), repeat),
+        )
+
+    chunk = demo_data(int(SHIFT_LENGTH * FS))
+    state = {"array": np.zeros((FS * BUFFER_LENGTH, 1)), "filter": None}
+
+    def update_array():
+        state["array"], state["filter"] = utils.update_buffer(
+            state["array"], chunk, notch=True, filter_state=state["filter"]
+        )
+
+    report("update_buffer [ndarray, notch]", timeit(update_array, repeat))
+    ring = utils.RingBuffer(FS * BUFFER_LENGTH, 1)
+    report("update_buffer [RingBuffer]", timeit(lambda: utils.update_buffer(ring, chunk), repeat))
+
+    recording = demo_data(FS * 60, 4)
+    samples_epoch = int(EPOCH_LENGTH * FS)
+    samples_overlap = int((EPOCH_LENGTH - SHIFT_LENGTH) * FS)
+    report("epoch [60 s x 4 channels]", timeit(lambda: utils.epoch(recording, samples_epoch, samples_overlap), repeat))
+    epochs = utils.epoch(recording, samples_epoch, samples_overlap)
+    report(
+        f"compute_feature_matrix [{epochs.shape[2]} epochs]",
+        timeit(lambda: utils.compute_feature_matrix(epochs, FS), max(repeat // 100, 1)),
+    )
+
+    band_powers = np.random.default_rng(0).uniform(0.5, 2, (100, 4))
+    report("calculate_extended_metrics", timeit(lambda: calculate_extended_metrics(band_powers[0]), repeat))
+    report(
+        "calculate_extended_metrics_matrix [100]",
+        timeit(lambda: calculate_extended_metrics_matrix(band_powers), repeat),
+    )
+
+    tracker = MetricsTracker()
+    for metrics in calculate_extended_metrics_matrix(band_powers):
+        tracker.add_metrics_vector(metrics)
+    report("MetricsTracker.get_summary", timeit(tracker.get_summary, repeat))
+
+
+def bench_pipeline(repeat, incremental=False):
+    """One tick of main.py: acquire, band powers, metrics and trackers for every session"""
+    for n_sessions in SESSION_COUNTS:
+        inlets = [DemoInlet(FS, as_array=True, pace=False, seed=i) for i in range(n_sessions)]
+        n_smooth = int(np.floor((BUFFER_LENGTH - EPOCH_LENGTH) / SHIFT_LENGTH + 1))
+        engine = BandPowerEngine.from_inlets(inlets, FS, n_smooth=n_smooth, incremental=incremental)
+        trackers = [MetricsTracker() for _ in inlets]
+
+        def tick(engine=engine, trackers=trackers):
+            engine.pull(max_samples=int(SHIFT_LENGTH * FS))
+            engine.compute_band_powers()
+            metrics_matrix = calculate_extended_metrics_matrix(engine.smooth_band_powers().mean(axis=1))
+            for session, tracker in enumerate(trackers):
+                tracker.add_metrics_vector(metrics_matrix[session])
+
+        mode = "incremental" if incremental else "fft"
+        report(f"pipeline tick [{mode}, {n_sessions} sessions]", timeit(tick, max(repeat // n_sessions, 10)), 1)
+
+
+def bench_band_powers(repeat, warmup=10):
+    """Band power stage of a tick (compute_band_powers and smooth_band_powers) with one FFT
+    per epoch or incremental, after a chunk was appended to every session. The speed-up of
+    the incremental mode is reported for a 50 ms shift and SHIFT_LENGTH"""
+    for shift in (0.05, SHIFT_LENGTH):
+        chunk = demo_data(int(shift * FS))
+        n_smooth = int(np.floor((BUFFER_LENGTH - EPOCH_LENGTH) / shift + 1))
+        for n_sessions in SESSION_COUNTS:
+            durations = {}
+            for incremental in (False, True):
+                engine = BandPowerEngine(n_sessions, FS, n_smooth=n_smooth, incremental=incremental)
+                n_ticks = max(repeat // n_sessions, 100)
+                duration = 0
+                for tick in range(warmup + n_ticks):
+                    for session in range(n_sessions):
+                        engine.append(session, chunk)
+                    start = time.perf_counter()
+                    engine.compute_band_powers()
+                    engine.smooth_band_powers()
+                    if tick >= warmup:
+                        duration += time.perf_counter() - start
+                durations[incremental] = duration / n_ticks
+
+            label = f"{shift * 1000:.0f} ms shift, {n_sessions} sessions"
+            report(f"band powers [fft, {label}]", durations[False], 1)
+            report(f"band powers [incremental, {label}]", durations[True], 1, baseline=durations[False])
+
+
+def bench_broadcast(n_frames):
+    """Time from send_data to every client having received the frames"""
+    port = 8799
+    server = WebSocketServer("localhost", port)
+    server.start()
+    while server.loop is None:
+        time.sleep(0.01)
+    time.sleep(0.2)
+
+    frame = {
+        "type": "real_time",
+        "session": 0,
+        "metrics": dict.fromkeys(METRIC_NAMES, 1.0),
+        "timestamp": time.time(),
+    }
+    for n_clients in SESSION_COUNTS:
+        connected = threading.Barrier(n_clients + 1)
+        received = threading.Barrier(n_clients + 1)
+
+        async def client(connected=connected, received=received):
+            async with websockets.connect(f"ws://localhost:{port}/?queue={n_frames}") as websocket:
+                connected.wait()
+                for _ in range(n_frames):
+                    await websocket.recv()
+                received.wait()
+
+        # New clients would first get the latest frame of the previous run
+        server.latest_data.clear()
+        # Barrier.wait blocks, so every client gets its own thread and loop
+        threads = [threading.Thread(target=asyncio.run, args=(client(),)) for _ in range(n_clients)]
+        for thread in threads:
+            thread.start()
+        connected.wait()
+        time.sleep(0.2)  # Let the server register the last clients
+
+        start = time.perf_counter()
+        for _ in range(n_frames):
+            server.send_data(frame)
+        received.wait()
+        duration = (time.perf_counter() - start) / n_frames
+        for thread in threads:
+            thread.join()
+        report(f"broadcast [{n_clients} clients]", duration, 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=1000, help="calls per function benchmark")
+    parser.add_argument("--frames", type=int, default=100, help="frames per broadcast benchmark")
+    parser.add_argument("--no-broadcast", action="store_true", help="skip the WebSocket benchmarks")
+    args = parser.parse_args()
+
+    bench_functions(args.repeat)
+    bench_pipeline(args.repeat)
+    bench_pipeline(args.repeat, incremental=True)
+    bench_band_powers(args.repeat)
+    if not args.no_broadcast:
+        bench_broadcast(args.frames)
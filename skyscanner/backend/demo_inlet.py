@@ -2,33 +2,101 @@ import time
 
 import numpy as np
 
+# Default content of the fake EEG: (frequency in Hz, amplitude) of each sine
+DEMO_COMPONENTS = (
+    (10, 10),  # Alpha (10 Hz)
+    (20, 5),  # Beta (20 Hz)
+)
+DEMO_NOISE = 3
+
 
 class DemoInlet:
-    def __init__(self, fs, num_channels=1):
+    """Fake EEG stream with the pull_chunk API of StreamInlet.
+
+    Every channel is a sum of sines plus gaussian noise. The sines keep their
+    phase from one chunk to the next, and each channel starts at a random phase.
+
+    Args:
+        fs (float): sampling frequency
+        num_channels (int): number of channels
+        components (tuple): (frequency in Hz, amplitude) of each sine; the
+            amplitude may also be a sequence with one value per channel
+        noise (float): standard deviation of the noise
+        as_array (bool): return numpy arrays instead of lists. The arrays are
+            reused buffers, overwritten by the next pull_chunk
+        pace (bool): sleep so that samples come at "fs" from the creation of
+            the inlet, as a live stream. Without pacing chunks are generated as
+            fast as they are pulled
+        seed (int): seed of the random generator
+    """
+
+    def __init__(
+        self, fs, num_channels=1, components=DEMO_COMPONENTS, noise=DEMO_NOISE, as_array=False, pace=True, seed=None
+    ):
         self.fs = fs
         self.num_channels = num_channels
-        self.last_pull = time.time()
+        self.noise = noise
+        self.as_array = as_array
+        self.pace = pace
+        self.start_time = time.time()
+
+        self.rng = np.random.default_rng(seed)
+        self.frequencies = [frequency for frequency, _ in components]
+        self.amplitudes = [
+            np.broadcast_to(np.asarray(amplitude, dtype=float), num_channels) for _, amplitude in components
+        ]
+        self.phases = [self.rng.uniform(0, 2 * np.pi, num_channels) for _ in components]
+        self.n_samples = 0  # Samples generated so far
+
+        self._allocate(256)
+
+    def _allocate(self, max_samples):
+        """(Re)allocate the buffers for chunks of up to "max_samples" samples"""
+        self._sample_index = np.arange(max_samples, dtype=float)[:, np.newaxis]
+        self._data = np.zeros((max_samples, self.num_channels))
+        self._scratch = np.zeros((max_samples, self.num_channels))
+        self._timestamps = np.zeros(max_samples)
 
     def pull_chunk(self, timeout=1, max_samples=256):
-        # Enforce real-time pacing
-        expected_duration = max_samples / self.fs
-        now = time.time()
-        elapsed = now - self.last_pull
-        delay = expected_duration - elapsed
-        if delay > 0:
-            time.sleep(delay)
-        self.last_pull = time.time()
-
-        # Generate fake EEG signal
-        t = np.linspace(0, max_samples / self.fs, max_samples, endpoint=False)
-        fake_signal = (
-            10 * np.sin(2 * np.pi * 10 * t)  # Alpha (10 Hz)
-            + 5 * np.sin(2 * np.pi * 20 * t)  # Beta (20 Hz)
-            + 3 * np.random.randn(max_samples)  # Noise
-        )
-        data = np.expand_dims(fake_signal, axis=1)  # Shape (samples, 1 channel)
-        timestamps = list(self.last_pull + t)
-        return data.tolist(), timestamps
+        if self.pace:
+            # Enforce real-time pacing: wait until the last sample of the chunk
+            # is due. The schedule is absolute, so sleeping late does not make
+            # the stream fall behind its sample timestamps
+            delay = self.start_time + (self.n_samples + max_samples) / self.fs - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        if max_samples > len(self._data):
+            self._allocate(max_samples)
+        data = self._data[:max_samples]
+        scratch = self._scratch[:max_samples]
+        sample_index = self._sample_index[:max_samples]
+
+        # Generate fake EEG signal, in place
+        if self.noise:
+            self.rng.standard_normal(out=data)
+            data *= self.noise
+        else:
+            data[:] = 0
+        for i, frequency in enumerate(self.frequencies):
+            omega = 2 * np.pi * frequency / self.fs
+            np.multiply(sample_index, omega, out=scratch)
+            scratch += self.phases[i]
+            np.sin(scratch, out=scratch)
+            scratch *= self.amplitudes[i]
+            data += scratch
+            # Continue from the next sample on the next chunk
+            self.phases[i] = (self.phases[i] + omega * max_samples) % (2 * np.pi)
+
+        timestamps = self._timestamps[:max_samples]
+        np.add(sample_index[:, 0], self.n_samples, out=timestamps)
+        timestamps /= self.fs
+        timestamps += self.start_time
+        self.n_samples += max_samples
+
+        if self.as_array:
+            return data, timestamps
+        return data.tolist(), timestamps.tolist()
 
     def time_correction(self):
         return 0.0
@@ -38,6 +106,9 @@ class DemoInlet:
             def nominal_srate(self_inner):
                 return self.fs
 
+            def channel_count(self_inner):
+                return self.num_channels
+
             def desc(self_inner):
                 return {}
 
@@ -0,0 +1,190 @@
+"""Band power computation sharded across worker processes
+
+With many headsets, the filtering and FFTs of every session no longer fit in
+one Python process (the GIL serializes them). DSPSupervisor keeps the inlets
+in the main process, which also runs the WebSocket server, and shards the
+sessions across a pool of worker processes, each running a BandPowerEngine
+for its shard:
+
+- On every tick the supervisor pulls a chunk from every inlet and writes it to
+  the shared memory input block of the session's worker.
+- All workers are then told to process their shard, in parallel, and write
+  the band powers of their sessions to their shared memory output block.
+- The supervisor gathers the band powers of every session, from which the main
+  process computes the metrics of all sessions at once.
+
+Only small control messages go through pipes, the samples and band powers are
+exchanged through multiprocessing.shared_memory.
+"""
+
+import multiprocessing as mp
+import signal
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from band_power_engine import BandPowerEngine
+
+
+def _attach(name, shape):
+    """Attach to a shared memory block and view it as a float64 array"""
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=np.float64, buffer=block.buf)
+
+
+def _worker_main(conn, input_name, input_shape, output_name, output_shape, fs, engine_kwargs):
+    """Process the sessions of one shard on every tick, until told to stop
+
+    Input block: [n_sessions, max_chunk + 1, n_channels], row 0 holding the
+    number of new samples of each session in its first column.
+    Output block: [2, n_sessions, n_channels, 4], raw and smoothed band powers.
+    """
+    # Ctrl+C reaches the whole process group, the supervisor stops the workers (see DSPSupervisor.close)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    input_block, chunks = _attach(input_name, input_shape)
+    output_block, band_powers = _attach(output_name, output_shape)
+    n_sessions, _, n_channels = input_shape
+    # Channels were already selected by the supervisor
+    engine = BandPowerEngine(n_sessions, fs, channels=range(n_channels), **engine_kwargs)
+
+    try:
+        while conn.recv():
+            for session in range(n_sessions):
+                n_new = int(chunks[session, 0, 0])
+                if n_new:
+                    engine.append(session, chunks[session, 1 : n_new + 1])
+            band_powers[0] = engine.compute_band_powers()
+            band_powers[1] = engine.smooth_band_powers()
+            conn.send(True)
+    finally:
+        del chunks, band_powers
+        input_block.close()
+        output_block.close()
+
+
+class DSPSupervisor:
+    """Drop-in replacement of BandPowerEngine running the DSP in worker processes.
+
+    Args:
+        inlets (list): one inlet per session
+        fs (float): sampling frequency shared by all sessions
+        n_workers (int): number of worker processes
+        channels (list): index of the channel(s) kept from each incoming chunk
+        max_chunk (int): maximum number of samples pulled per inlet and tick
+        latency (latency.LatencyStats): records the duration of the acquire
+            stage and of the work of the workers (as fft), None for no instrumentation
+        **engine_kwargs: other BandPowerEngine arguments (epoch_length, n_smooth, ...)
+    """
+
+    def __init__(self, inlets, fs, n_workers, channels=(0,), max_chunk=256, latency=None, **engine_kwargs):
+        self.inlets = list(inlets)
+        self.fs = fs
+        self.latency = latency
+        # Same as BandPowerEngine.sample_timestamps
+        self.sample_timestamps = np.full(len(self.inlets), np.nan)
+        self.time_corrections = np.array([inlet.time_correction() for inlet in self.inlets], dtype=float)
+        self.channels = list(channels)
+        self.max_chunk = max_chunk
+        n_channels = len(self.channels)
+        self.band_shape = (len(self.inlets), n_channels, 4)
+
+        # Contiguous shards of sessions, one per worker
+        n_workers = max(1, min(n_workers, len(self.inlets)))
+        self.shards = [shard.tolist() for shard in np.array_split(np.arange(len(self.inlets)), n_workers)]
+
+        self.blocks = []
+        self.inputs = []
+        self.outputs = []
+        self.connections = []
+        self.processes = []
+        for shard in self.shards:
+            input_shape = (len(shard), max_chunk + 1, n_channels)
+            output_shape = (2, len(shard), n_channels, 4)
+            input_block = shared_memory.SharedMemory(create=True, size=int(np.prod(input_shape)) * 8)
+            output_block = shared_memory.SharedMemory(create=True, size=int(np.prod(output_shape)) * 8)
+            self.blocks += [input_block, output_block]
+            self.inputs.append(np.ndarray(input_shape, dtype=np.float64, buffer=input_block.buf))
+            self.outputs.append(np.ndarray(output_shape, dtype=np.float64, buffer=output_block.buf))
+
+            conn, worker_conn = mp.Pipe()
+            process = mp.Process(
+                target=_worker_main,
+                args=(
+                    worker_conn,
+                    input_block.name,
+                    input_shape,
+                    output_block.name,
+                    output_shape,
+                    fs,
+                    engine_kwargs,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self.connections.append(conn)
+            self.processes.append(process)
+
+        self._band_powers = np.zeros((2,) + self.band_shape)
+
+    def pull(self, max_samples, timeout=1):
+        """Pull a chunk from every inlet into the shared input blocks"""
+        start = time.perf_counter()
+        max_samples = min(max_samples, self.max_chunk)
+        for shard, chunks in zip(self.shards, self.inputs):
+            for i, session in enumerate(shard):
+                eeg_data, timestamps = self.inlets[session].pull_chunk(timeout=timeout, max_samples=max_samples)
+                n_new = len(eeg_data)
+                if n_new:
+                    chunks[i, 1 : n_new + 1] = np.asarray(eeg_data)[:, self.channels]
+                    self.sample_timestamps[session] = timestamps[-1] + self.time_corrections[session]
+                chunks[i, 0, 0] = n_new
+        if self.latency is not None:
+            self.latency.record("acquire", time.perf_counter() - start)
+
+    def compute_band_powers(self):
+        """Process the pulled chunks in all workers and gather their band powers
+
+        Returns:
+            (numpy.ndarray): log10 band powers of shape [sessions, channels, 4]
+
+        Raises:
+            RuntimeError: if a worker died
+        """
+        start = time.perf_counter()
+        try:
+            for conn in self.connections:
+                conn.send(True)
+            for shard, conn, band_powers in zip(self.shards, self.connections, self.outputs):
+                conn.recv()
+                self._band_powers[:, shard] = band_powers
+        except (EOFError, OSError) as error:
+            # The pipe of a dead worker is closed
+            dead = [process for process in self.processes if not process.is_alive()]
+            exit_codes = ", ".join(f"{process.name} (exit code {process.exitcode})" for process in dead)
+            raise RuntimeError(f"DSP worker died: {exit_codes or 'unknown worker'}") from error
+        if self.latency is not None:
+            self.latency.record("fft", time.perf_counter() - start)
+        return self._band_powers[0]
+
+    def smooth_band_powers(self):
+        """Average of the band powers over the band buffer, shape [sessions, channels, 4]"""
+        return self._band_powers[1]
+
+    def close(self):
+        """Stop the workers and release the shared memory"""
+        for conn, process in zip(self.connections, self.processes):
+            if process.is_alive():
+                try:
+                    conn.send(False)
+                except OSError:
+                    pass
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self.inputs = self.outputs = []
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
@@ -0,0 +1,87 @@
+"""Latency instrumentation of the processing pipeline
+
+LatencyStats keeps the most recent durations of every stage of a tick, from
+acquisition to the hand-off of the frames to the WebSocket clients, and
+reports their percentiles. It is shared by the main loop, the band power
+engine and the WebSocket server thread.
+
+Stages:
+
+- acquire: pulling the chunks of every inlet
+- filter: filtering them into the raw EEG buffers
+- fft: band powers of the newest epochs (with DSP workers, filter and fft of
+  the workers are timed together as fft)
+- metrics: metrics of every session and their trackers
+- serialize: encoding of a frame for the clients, in the server thread
+- broadcast: from send_data to the frame queued for every client, including
+  the hand-off to the server thread
+- end_to_end: from the newest sample of a session (its LSL timestamp,
+  corrected to the local clock) to its frame being queued for every client,
+  in the server thread (so including serialize and broadcast)
+"""
+
+import threading
+
+import numpy as np
+
+# Stages of a tick, in pipeline order (other stage names are reported after them)
+STAGES = ("acquire", "filter", "fft", "metrics", "serialize", "broadcast", "end_to_end")
+
+# Number of most recent durations kept per stage
+LATENCY_WINDOW = 1000
+
+PERCENTILES = (50, 95, 99)
+
+
+class LatencyStats:
+    """Rolling window of the durations of every pipeline stage.
+
+    Safe to use from several threads.
+
+    Args:
+        window (int): number of most recent durations kept per stage
+    """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.durations = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, duration):
+        """Add the duration (in seconds) of one run of a stage"""
+        with self.lock:
+            if stage not in self.durations:
+                self.durations[stage] = np.zeros(self.window)
+                self.counts[stage] = 0
+            self.durations[stage][self.counts[stage] % self.window] = duration
+            self.counts[stage] += 1
+
+    def get_percentiles(self):
+        """Percentiles of the recent durations of every stage, in milliseconds
+
+        Returns:
+            (dict): {stage: {"count", "p50", "p95", "p99", "max"}}, "count"
+                being the number of runs since the start
+        """
+        with self.lock:
+            stages = [stage for stage in STAGES if stage in self.durations]
+            stages += sorted(set(self.durations) - set(STAGES))
+            windows = {stage: self.durations[stage][: min(self.counts[stage], self.window)].copy() for stage in stages}
+            counts = dict(self.counts)
+
+        percentiles = {}
+        for stage, durations in windows.items():
+            values = np.percentile(durations, PERCENTILES) * 1e3
+            percentiles[stage] = {"count": counts[stage]}
+            percentiles[stage].update({f"p{p}": round(value, 3) for p, value in zip(PERCENTILES, values.tolist())})
+            percentiles[stage]["max"] = round(float(durations.max()) * 1e3, 3)
+        return percentiles
+
+    def format_summary(self):
+        """Percentiles of every stage as printable lines"""
+        lines = []
+        for stage, stats in self.get_percentiles().items():
+            values = " ".join(f"{name}={value:.2f}" for name, value in stats.items() if name != "count")
+            lines.append(f"{stage:<12} {values} ms (n={stats['count']})")
+        return "\n".join(lines)
@@ -15,14 +15,20 @@ Adapted from https://github.com/NeuroTechX/bci-workshop
 """
 
 import asyncio
+import os
 import time
 
 import numpy as np
-from pylsl import StreamInlet, resolve_byprop  # Module to receive EEG data
+from pylsl import StreamInlet, local_clock, resolve_byprop  # Module to receive EEG data
 
-import utils  # Our own utility functions
+import utils
+from band_power_engine import BandPowerEngine
 from demo_inlet import DemoInlet
-from metrics_tracker import MetricsTracker
+from dsp_workers import DSPSupervisor
+from latency import LatencyStats
+from metrics_tracker import METRIC_NAMES, MetricsTracker
+from recording import RecordingInlet, ReplayInlet, SessionRecorder
+from session_store import SessionStore
 from ws_server import WebSocketServer
 
 
@@ -50,10 +56,57 @@ OVERLAP_LENGTH = 0.8
 # Amount to 'shift' the start of each next consecutive epoch
 SHIFT_LENGTH = EPOCH_LENGTH - OVERLAP_LENGTH
 
-# Index of the channel(s) (electrodes) to be used
+# Filtering of the raw EEG: the 60 Hz notch filter is always applied, these add
+# a high-pass stage (cutoff in Hz, None for none) and notches at line-noise harmonics
+HIGHPASS_CUTOFF = None
+LINE_NOISE_HARMONICS = 0
+
+# Update the band powers incrementally (sliding DFT) instead of recomputing the
+# FFT of the whole epoch on every shift. Makes short shifts (e.g. 0.05 s) cheap,
+# see the band powers benchmark of benchmark.py. EPOCH_LENGTH * fs must then be
+# a power of 2.
+INCREMENTAL = False
+
+# Spectrum estimator of the band powers: "fft" (one Hamming-windowed FFT per
+# epoch), "welch" or "multitaper" (see utils.PSDMethod). The last two have a
+# lower variance, so a shorter BUFFER_LENGTH smooths as well, with less lag.
+# They are scaled alike (same log10 band powers on white noise, and in the band
+# of a sine), but leak differently into the other bands: the wider DPSS tapers
+# of "multitaper" and the 2 Hz resolution of the half-length "welch" segments
+# spread a strong rhythm into its neighbours, e.g. a 10 Hz sine gives a delta
+# power of -2.5 with "multitaper" against -4.8 with "fft". The metrics are
+# ratios of log powers, so they are not interchangeable between estimators.
+# INCREMENTAL only supports "fft".
+PSD_METHOD = utils.PSDMethod.FFT
+
+# Index of the channel(s) (electrodes) to be used, for every headset
 # 0 = left ear, 1 = left forehead, 2 = right forehead, 3 = right ear
 INDEX_CHANNEL = [0]
 
+# Number of worker processes the band power computation of the headsets is
+# sharded across (0 to compute everything in this process)
+DSP_WORKERS = 0
+
+# Number of simulated headsets when no EEG stream is found
+NUM_DEMO_SESSIONS = 1
+
+# Record the raw EEG of every headset to RECORD_DIR/<headset> (None to disable)
+RECORD_DIR = None
+
+# Replay the recordings in REPLAY_DIR instead of live streams (None to disable),
+# at REPLAY_SPEED times real time (None for as fast as possible)
+REPLAY_DIR = None
+REPLAY_SPEED = 1.0
+
+# Store the metrics and summaries of every session in this SQLite database,
+# e.g. "sessions.db" (None to disable). The history is served at
+# http://WS_HOST:WS_PORT/history
+SESSION_STORE = None
+
+# Print the latency percentiles of every pipeline stage every LATENCY_LOG_INTERVAL
+# seconds (None to disable). They are also served at http://WS_HOST:WS_PORT/stats
+LATENCY_LOG_INTERVAL = 10
+
 # WebSocket server settings
 WS_HOST = "localhost"
 WS_PORT = 8765
@@ -61,78 +114,149 @@ WS_PORT = 8765
 
 def calculate_extended_metrics(smooth_band_powers):
     """Calculate additional EEG metrics beyond the basic ones"""
+    metrics = calculate_extended_metrics_matrix(np.asarray(smooth_band_powers)[np.newaxis])[0]
+    return metrics_to_dict(metrics)
+
+
+def metrics_to_dict(metrics):
+    """Named view of a metrics vector for serialization, nan (not valid JSON) becomes None"""
+    return {name: value if np.isfinite(value) else None for name, value in zip(METRIC_NAMES, metrics.tolist())}
+
+
+def calculate_extended_metrics_matrix(band_powers):
+    """Calculate the metrics of many band power vectors at once
+
+    Args:
+        band_powers (numpy.ndarray): band powers of shape [N, 4] (sessions,
+            channels or ticks), ordered as Band
+
+    Returns:
+        (numpy.ndarray): metrics of shape [N, 7], columns ordered as
+            METRIC_NAMES. A ratio is nan when its denominator is zero or
+            when either side is not finite (e.g. -inf log power of a flat epoch).
+    """
+    band_powers = np.asarray(band_powers, dtype=float)
+    delta = band_powers[:, Band.Delta]
+    theta = band_powers[:, Band.Theta]
+    alpha = band_powers[:, Band.Alpha]
+    beta = band_powers[:, Band.Beta]
+
+    # Columns are (numerator, denominator) of each metric
+    numerators = np.empty((len(band_powers), len(METRIC_NAMES)))
+    denominators = np.empty_like(numerators)
+
     # Basic metrics (already in the original code)
-    alpha_metric = smooth_band_powers[Band.Alpha] / smooth_band_powers[Band.Delta]
-    beta_metric = smooth_band_powers[Band.Beta] / smooth_band_powers[Band.Theta]
-    theta_metric = smooth_band_powers[Band.Theta] / smooth_band_powers[Band.Alpha]
+    # Alpha relaxation: Alpha / Delta
+    numerators[:, 0], denominators[:, 0] = alpha, delta
+    # Beta concentration: Beta / Theta
+    numerators[:, 1], denominators[:, 1] = beta, theta
+    # Theta relaxation: Theta / Alpha
+    numerators[:, 2], denominators[:, 2] = theta, alpha
 
     # Additional metrics:
 
     # 1. Engagement Index: Beta / (Alpha + Theta)
     # Higher values indicate higher engagement/attention
-    engagement_index = smooth_band_powers[Band.Beta] / (smooth_band_powers[Band.Alpha] + smooth_band_powers[Band.Theta])
+    numerators[:, 3], denominators[:, 3] = beta, alpha + theta
 
     # 2. Arousal Index: Beta / Alpha
     # Indicates cognitive arousal or alertness
-    arousal_index = smooth_band_powers[Band.Beta] / smooth_band_powers[Band.Alpha]
+    numerators[:, 4], denominators[:, 4] = beta, alpha
 
     # 3. Frustration/Anxiety Index: (Beta + Theta) / Alpha
     # Higher values may indicate frustration or anxiety
-    frustration_index = (smooth_band_powers[Band.Beta] + smooth_band_powers[Band.Theta]) / smooth_band_powers[
-        Band.Alpha
-    ]
+    numerators[:, 5], denominators[:, 5] = beta + theta, alpha
 
     # 4. Mindfulness Index: Theta / Beta
     # Higher values may indicate a meditative or mindful state
-    mindfulness_index = smooth_band_powers[Band.Theta] / smooth_band_powers[Band.Beta]
-
-    return {
-        "alpha_relaxation": alpha_metric,
-        "beta_concentration": beta_metric,
-        "theta_relaxation": theta_metric,
-        "engagement_index": engagement_index,
-        "arousal_index": arousal_index,
-        "frustration_index": frustration_index,
-        "mindfulness_index": mindfulness_index,
-    }
+    numerators[:, 6], denominators[:, 6] = theta, beta
 
+    valid = np.isfinite(numerators) & np.isfinite(denominators) & (denominators != 0)
+    metrics = np.full_like(numerators, np.nan)
+    np.divide(numerators, denominators, out=metrics, where=valid)
+    return metrics
 
-if __name__ == "__main__":
-    """ 1. CONNECT TO EEG STREAM """
 
-    # Search for active LSL streams
-    print("Looking for an EEG stream...")
-    streams = resolve_byprop("type", "EEG", timeout=2)
-    if len(streams) == 0:
+if __name__ == "__main__":
+    """ 1. CONNECT TO EEG STREAMS """
+
+    # Search for active LSL streams, one session per headset
+    print("Looking for EEG streams...")
+    streams = [] if REPLAY_DIR else resolve_byprop("type", "EEG", timeout=2)
+    if REPLAY_DIR:
+        # One session per recording
+        headsets = sorted(os.listdir(REPLAY_DIR))
+        print(f"Replaying {len(headsets)} recording(s) from {REPLAY_DIR}.")
+        inlets = [ReplayInlet(os.path.join(REPLAY_DIR, headset), speed=REPLAY_SPEED) for headset in headsets]
+        fs = inlets[0].info().nominal_srate()
+        # Recorded timestamps are in the past, there is no end-to-end latency
+        sample_clock = None
+    elif len(streams) == 0:
         print("No EEG stream found. Switching to fake EEG data generator.")
-        inlet = DemoInlet(fs=256)
-        fs = inlet.info().nominal_srate()
+        inlets = [
+            DemoInlet(fs=256, num_channels=max(INDEX_CHANNEL) + 1, as_array=True) for _ in range(NUM_DEMO_SESSIONS)
+        ]
+        headsets = [f"demo-{session}" for session in range(NUM_DEMO_SESSIONS)]
+        fs = inlets[0].info().nominal_srate()
+        # Fake samples are timestamped with the system clock
+        sample_clock = time.time
         asyncio.sleep(10)
     else:
-        inlet = StreamInlet(streams[0], max_chunklen=12)
-        eeg_time_correction = inlet.time_correction()
-        info = inlet.info()
+        print(f"Found {len(streams)} EEG stream(s).")
+        inlets = [StreamInlet(stream, max_chunklen=12) for stream in streams]
+        headsets = [stream.source_id() or stream.name() for stream in streams]
+        # LSL timestamps (corrected by the engine with the time correction of
+        # their inlet) are on the LSL local clock
+        sample_clock = local_clock
+        info = inlets[0].info()
         description = info.desc()
         fs = int(info.nominal_srate())
 
-    """ 2. INITIALIZE BUFFERS AND SERVICES """
+    if RECORD_DIR:
+        recorders = [SessionRecorder(os.path.join(RECORD_DIR, headset), fs) for headset in headsets]
+        inlets = [RecordingInlet(inlet, recorder) for inlet, recorder in zip(inlets, recorders)]
 
-    # Initialize raw EEG data buffer
-    eeg_buffer = np.zeros((int(fs * BUFFER_LENGTH), 1))
-    filter_state = None  # for use with the notch filter
+    """ 2. INITIALIZE BUFFERS AND SERVICES """
 
     # Compute the number of epochs in "buffer_length"
     n_win_test = int(np.floor((BUFFER_LENGTH - EPOCH_LENGTH) / SHIFT_LENGTH + 1))
 
-    # Initialize the band power buffer (for plotting)
+    # Durations of every pipeline stage
+    latency = LatencyStats()
+
+    # Initialize the raw EEG buffers of every session and the band power buffer
     # bands will be ordered: [delta, theta, alpha, beta]
-    band_buffer = np.zeros((n_win_test, 4))
+    engine_kwargs = {
+        "buffer_length": BUFFER_LENGTH,
+        "epoch_length": EPOCH_LENGTH,
+        "n_smooth": n_win_test,
+        "highpass": HIGHPASS_CUTOFF,
+        "n_harmonics": LINE_NOISE_HARMONICS,
+        "incremental": INCREMENTAL,
+        "psd_method": PSD_METHOD,
+    }
+    if DSP_WORKERS:
+        # Started before the WebSocket server thread, so the workers are forked without it
+        engine = DSPSupervisor(
+            inlets,
+            fs,
+            DSP_WORKERS,
+            channels=INDEX_CHANNEL,
+            max_chunk=int(SHIFT_LENGTH * fs),
+            latency=latency,
+            **engine_kwargs,
+        )
+    else:
+        engine = BandPowerEngine.from_inlets(inlets, fs, channels=INDEX_CHANNEL, latency=latency, **engine_kwargs)
 
-    # Initialize metrics tracker
-    metrics_tracker = MetricsTracker()
+    # Initialize one metrics tracker per session
+    metrics_trackers = [MetricsTracker() for _ in inlets]
+
+    # Metrics history, written to disk by a background thread
+    store = SessionStore(SESSION_STORE) if SESSION_STORE else None
 
     # Initialize and start WebSocket server
-    ws_server = WebSocketServer(WS_HOST, WS_PORT)
+    ws_server = WebSocketServer(WS_HOST, WS_PORT, latency=latency, store=store, sample_clock=sample_clock)
     ws_thread = ws_server.start()
     print(f"WebSocket server running at ws://{WS_HOST}:{WS_PORT}")
 
@@ -142,53 +266,89 @@ if __name__ == "__main__":
     # script with <Ctrl-C>
     print("Press Ctrl-C in the console to break the while loop.")
 
+    last_latency_log = time.time()
     try:
         # Acquires data, computes band powers, and calculates neurofeedback metrics based on those band powers
         while True:
             """ 3.1 ACQUIRE DATA """
-            eeg_data, timestamp = inlet.pull_chunk(timeout=1, max_samples=int(SHIFT_LENGTH * fs))
-            ch_data = np.array(eeg_data)[:, INDEX_CHANNEL]  # Only keep the channel we're interested in
-            eeg_buffer, filter_state = utils.update_buffer(eeg_buffer, ch_data, notch=True, filter_state=filter_state)
+            engine.pull(max_samples=int(SHIFT_LENGTH * fs), timeout=1)
 
             """ 3.2 COMPUTE BAND POWERS """
-            # Get the newest samples from the buffer
-            data_epoch = utils.get_last_data(eeg_buffer, EPOCH_LENGTH * fs)
-
-            # Compute band powers
-            band_powers = utils.compute_band_powers(data_epoch, fs)
-            band_buffer, _ = utils.update_buffer(band_buffer, np.asarray([band_powers]))
+            # Compute band powers of all sessions and channels in one FFT
+            engine.compute_band_powers()
             # Compute the average band powers for all epochs in buffer
             # This helps to smooth out noise
-            smooth_band_powers = np.mean(band_buffer, axis=0)
+            # Channels are averaged to get one set of band powers per session
+            smooth_band_powers = engine.smooth_band_powers().mean(axis=1)
 
             """ 3.3 COMPUTE NEUROFEEDBACK METRICS """
-            # Calculate all metrics (basic and extended)
-            metrics = calculate_extended_metrics(smooth_band_powers)
-
-            # Add metrics to tracker
-            metrics_tracker.add_metrics(
-                metrics["alpha_relaxation"],
-                metrics["beta_concentration"],
-                metrics["theta_relaxation"],
-                metrics["engagement_index"],
-                metrics["arousal_index"],
-                metrics["frustration_index"],
-                metrics["mindfulness_index"],
-            )
-
-            # Send real-time data via WebSocket
-            ws_data = {"type": "real_time", "metrics": metrics, "timestamp": time.time()}
-            ws_server.send_data(ws_data)
-
-            # Check if we should generate and send a summary
-            if metrics_tracker.should_summarize():
-                summary = metrics_tracker.get_summary()
-                print("\n=== SUMMARY ANALYSIS (Last 50 readings) ===")
-                print(summary["metrics"])
-
-                # Send summary via WebSocket
-                ws_data = {"type": "summary", "metrics": summary["metrics"], "timestamp": time.time()}
+            metrics_start = time.perf_counter()
+            # Calculate all metrics (basic and extended) of every session at once
+            metrics_matrix = calculate_extended_metrics_matrix(smooth_band_powers)
+
+            # Add metrics to the trackers
+            for session, metrics_tracker in enumerate(metrics_trackers):
+                metrics_tracker.add_metrics_vector(metrics_matrix[session])
+            latency.record("metrics", time.perf_counter() - metrics_start)
+
+            for session, metrics_tracker in enumerate(metrics_trackers):
+                # Timestamp of the newest sample the metrics were computed from
+                sample_timestamp = engine.sample_timestamps[session]
+                sample_timestamp = float(sample_timestamp) if np.isfinite(sample_timestamp) else None
+
+                # Named metrics are only built for serialization
+                metrics = metrics_to_dict(metrics_matrix[session])
+
+                # Send real-time data via WebSocket
+                ws_data = {
+                    "type": "real_time",
+                    "session": session,
+                    "headset": headsets[session],
+                    "metrics": metrics,
+                    "sample_timestamp": sample_timestamp,
+                    "timestamp": time.time(),
+                }
+                if store:
+                    store.add_metrics(
+                        session, headsets[session], metrics_matrix[session], ws_data["timestamp"], sample_timestamp
+                    )
                 ws_server.send_data(ws_data)
 
+                # Check if we should generate and send a summary
+                if metrics_tracker.should_summarize():
+                    summary = metrics_tracker.get_summary()
+                    print(f"\n=== SUMMARY ANALYSIS session {session} (Last 50 readings) ===")
+                    print(summary["metrics"])
+
+                    # Send summary via WebSocket
+                    ws_data = {
+                        "type": "summary",
+                        "session": session,
+                        "headset": headsets[session],
+                        "metrics": summary["metrics"],
+                        "horizons": metrics_tracker.get_horizon_summaries(),
+                        "timestamp": time.time(),
+                    }
+                    if store:
+                        store.add_summary(
+                            session,
+                            headsets[session],
+                            {"metrics": summary["metrics"], "horizons": ws_data["horizons"]},
+                            ws_data["timestamp"],
+                        )
+                    ws_server.send_data(ws_data)
+
+            if LATENCY_LOG_INTERVAL and time.time() - last_latency_log >= LATENCY_LOG_INTERVAL:
+                print("\n=== LATENCY (ms) ===")
+                print(latency.format_summary())
+                last_latency_log = time.time()
+
     except KeyboardInterrupt:
         print("Closing!")
+        if DSP_WORKERS:
+            engine.close()
+        if store:
+            store.close()
+        if RECORD_DIR:
+            for recorder in recorders:
+                recorder.close()
@@ -1,3 +1,4 @@
+import math
 import time
 from collections import deque
 
@@ -6,40 +7,240 @@ import numpy as np
 # Tracking iterations for summary analysis
 SUMMARY_INTERVAL = 50
 
+# Order of the metrics wherever they are stored or sent as a vector
+METRIC_NAMES = (
+    "alpha_relaxation",
+    "beta_concentration",
+    "theta_relaxation",
+    "engagement_index",
+    "arousal_index",
+    "frustration_index",
+    "mindfulness_index",
+)
+
+# Rolling summary horizons in seconds, None for the whole session
+HORIZONS = {"5s": 5, "1m": 60, "session": None}
+
+# Number of time buckets a rolling horizon is divided into
+HORIZON_BUCKETS = 10
+
+
+class HorizonAggregate:
+    """Incremental statistics of the metrics over the last "horizon" seconds.
+
+    The horizon is divided into time buckets, each holding the count, sum, sum
+    of squares, min and max of the metrics added during that bucket. Non-finite
+    values (e.g. nan ratios of a flat epoch) are skipped per metric, so that a
+    single one does not spoil the statistics of the whole horizon. Adding a
+    value updates one bucket and a query combines the buckets, so neither
+    depends on the number of values in the horizon. Buckets expire as a whole,
+    so the horizon is covered with a granularity of horizon / n_buckets.
+
+    With horizon=None there is a single bucket that never expires (whole session).
+    """
+
+    def __init__(self, horizon, n_metrics=len(METRIC_NAMES), n_buckets=HORIZON_BUCKETS):
+        self.horizon = horizon
+        self.n_buckets = n_buckets if horizon else 1
+        self.bucket_width = horizon / n_buckets if horizon else np.inf
+        self.bucket_ids = np.full(self.n_buckets, -1, dtype=np.int64)
+        self.counts = np.zeros((self.n_buckets, n_metrics), dtype=np.int64)
+        self.sums = np.zeros((self.n_buckets, n_metrics))
+        self.sums_sq = np.zeros((self.n_buckets, n_metrics))
+        self.mins = np.full((self.n_buckets, n_metrics), np.inf)
+        self.maxs = np.full((self.n_buckets, n_metrics), -np.inf)
+
+    def _bucket_id(self, timestamp):
+        return int(timestamp // self.bucket_width) if self.horizon else 0
+
+    def add(self, metrics, timestamp):
+        bucket_id = self._bucket_id(timestamp)
+        slot = bucket_id % self.n_buckets
+        if self.bucket_ids[slot] != bucket_id:
+            # The slot held an expired bucket
+            self.bucket_ids[slot] = bucket_id
+            self.counts[slot] = 0
+            self.sums[slot] = 0
+            self.sums_sq[slot] = 0
+            self.mins[slot] = np.inf
+            self.maxs[slot] = -np.inf
+
+        finite = np.isfinite(metrics)
+        values = np.where(finite, metrics, 0)
+        self.counts[slot] += finite
+        self.sums[slot] += values
+        self.sums_sq[slot] += values * values
+        # fmin and fmax ignore nan, -inf/inf are excluded explicitly
+        np.fmin(self.mins[slot], metrics, out=self.mins[slot], where=finite)
+        np.fmax(self.maxs[slot], metrics, out=self.maxs[slot], where=finite)
+
+    def get_statistics(self, timestamp):
+        """Count, mean, std, min and max of every metric over the horizon ending at "timestamp"
+
+        Counts are per metric (finite values only), the statistics of a metric
+        without any finite value are nan.
+        """
+        live = self.bucket_ids > self._bucket_id(timestamp) - self.n_buckets
+        counts = self.counts[live].sum(axis=0)
+        empty = counts == 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.sums[live].sum(axis=0) / counts
+            variance = np.maximum(self.sums_sq[live].sum(axis=0) / counts - mean * mean, 0)
+        return {
+            "count": counts,
+            "mean": mean,
+            "std": np.sqrt(variance),
+            "min": np.where(empty, np.nan, self.mins[live].min(axis=0, initial=np.inf)),
+            "max": np.where(empty, np.nan, self.maxs[live].max(axis=0, initial=-np.inf)),
+        }
+
 
 class MetricsTracker:
-    def __init__(self, max_size=SUMMARY_INTERVAL):
-        self.alpha_relaxation = deque(maxlen=max_size)
-        self.beta_concentration = deque(maxlen=max_size)
-        self.theta_relaxation = deque(maxlen=max_size)
-        self.engagement_index = deque(maxlen=max_size)
-        self.arousal_index = deque(maxlen=max_size)
-        self.frustration_index = deque(maxlen=max_size)
-        self.mindfulness_index = deque(maxlen=max_size)
+    """Rolling window of the last "max_size" metric vectors.
+
+    The vectors are stored in a [max_size, n_metrics] ring array with a running
+    sum and sum of squares, so the mean and variance of every metric cost O(1)
+    per update. Like in HorizonAggregate, only finite values are accumulated,
+    with a count per metric. Minimum and maximum are kept with monotonic deques, which skip
+    non-finite values.
+
+    Statistics over the time horizons of HORIZONS (e.g. last 5 s, last minute
+    and whole session) are kept alongside and can be queried at any time.
+    """
+
+    def __init__(self, max_size=SUMMARY_INTERVAL, horizons=HORIZONS):
+        self.max_size = max_size
+        self.n_metrics = len(METRIC_NAMES)
+        self.values = np.zeros((max_size, self.n_metrics))
+        self.count = 0
+        # Number of finite values of every metric in the window
+        self.finite_counts = np.zeros(self.n_metrics, dtype=np.int64)
+        self.sum = np.zeros(self.n_metrics)
+        self.sum_sq = np.zeros(self.n_metrics)
+        # (iteration, value) pairs with decreasing (max) or increasing (min) values
+        self.max_deques = [deque() for _ in METRIC_NAMES]
+        self.min_deques = [deque() for _ in METRIC_NAMES]
+        self.horizons = {name: HorizonAggregate(horizon, self.n_metrics) for name, horizon in horizons.items()}
         self.iterations = 0
 
     def add_metrics(self, alpha, beta, theta, engagement, arousal, frustration, mindfulness):
-        self.alpha_relaxation.append(alpha)
-        self.beta_concentration.append(beta)
-        self.theta_relaxation.append(theta)
-        self.engagement_index.append(engagement)
-        self.arousal_index.append(arousal)
-        self.frustration_index.append(frustration)
-        self.mindfulness_index.append(mindfulness)
+        self.add_metrics_vector((alpha, beta, theta, engagement, arousal, frustration, mindfulness))
+
+    def add_metrics_vector(self, metrics, timestamp=None):
+        """Add one value of every metric, ordered as METRIC_NAMES"""
+        metrics = np.asarray(metrics, dtype=float)
+        timestamp = time.time() if timestamp is None else timestamp
+        for horizon in self.horizons.values():
+            horizon.add(metrics, timestamp)
+
+        row = self.iterations % self.max_size
+
+        if self.count == self.max_size:
+            old = self.values[row]
+            old_finite = np.isfinite(old)
+            old = np.where(old_finite, old, 0)
+            self.finite_counts -= old_finite
+            self.sum -= old
+            self.sum_sq -= old * old
+        else:
+            self.count += 1
+        self.values[row] = metrics
+        finite = np.isfinite(metrics)
+        values = np.where(finite, metrics, 0)
+        self.finite_counts += finite
+        self.sum += values
+        self.sum_sq += values * values
+
+        # Drop rounding errors once per window
+        if row == self.max_size - 1:
+            window = self.values[: self.count]
+            window = np.where(np.isfinite(window), window, 0)
+            self.sum = window.sum(axis=0)
+            self.sum_sq = np.square(window).sum(axis=0)
+
+        oldest = self.iterations - self.max_size
+        for i_metric, value in enumerate(metrics.tolist()):
+            max_deque = self.max_deques[i_metric]
+            min_deque = self.min_deques[i_metric]
+            # Every comparison with nan is False, non-finite values would break the monotonic order
+            if math.isfinite(value):
+                while max_deque and max_deque[-1][1] <= value:
+                    max_deque.pop()
+                max_deque.append((self.iterations, value))
+                while min_deque and min_deque[-1][1] >= value:
+                    min_deque.pop()
+                min_deque.append((self.iterations, value))
+
+            if max_deque and max_deque[0][0] <= oldest:
+                max_deque.popleft()
+            if min_deque and min_deque[0][0] <= oldest:
+                min_deque.popleft()
+
         self.iterations += 1
 
     def should_summarize(self):
         return self.iterations % SUMMARY_INTERVAL == 0 and self.iterations > 0
 
+    def mean(self):
+        """Mean of the finite values of every metric over the window (nan without any)"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sum / self.finite_counts
+
+    def variance(self):
+        """Variance of the finite values of every metric over the window (nan without any)"""
+        mean = self.mean()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.maximum(self.sum_sq / self.finite_counts - mean * mean, 0)
+
+    def minimum(self):
+        """Minimum of every metric over the window"""
+        return np.array([min_deque[0][1] if min_deque else np.nan for min_deque in self.min_deques])
+
+    def maximum(self):
+        """Maximum of every metric over the window"""
+        return np.array([max_deque[0][1] if max_deque else np.nan for max_deque in self.max_deques])
+
+    def get_statistics(self, name):
+        """Mean, standard deviation, minimum and maximum of one metric over the window"""
+        i_metric = METRIC_NAMES.index(name)
+        return {
+            "mean": float(self.mean()[i_metric]),
+            "std": float(np.sqrt(self.variance()[i_metric])),
+            "min": float(self.minimum()[i_metric]),
+            "max": float(self.maximum()[i_metric]),
+        }
+
+    def get_horizon_statistics(self, name, timestamp=None):
+        """Count, mean, std, min and max of every metric over one horizon (see HORIZONS)
+
+        Returns:
+            (dict): for "count" and each statistic, a dict of metric name to
+                value, None (valid JSON, unlike nan) when a metric had no finite value
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        statistics = self.horizons[name].get_statistics(timestamp)
+        result = {}
+        for statistic, values in statistics.items():
+            result[statistic] = {
+                metric: value if np.isfinite(value) else None for metric, value in zip(METRIC_NAMES, values.tolist())
+            }
+        return result
+
+    def get_horizon_summaries(self, timestamp=None):
+        """Mean of every metric over every horizon, e.g. {"5s": {"metrics": {...}, "count": 25}, ...}
+
+        "count" is the largest number of finite values of a metric over the
+        horizon, a metric without any finite value has a None mean.
+        """
+        summaries = {}
+        for name in self.horizons:
+            statistics = self.get_horizon_statistics(name, timestamp)
+            summaries[name] = {"metrics": statistics["mean"], "count": max(statistics["count"].values())}
+        return summaries
+
     def get_summary(self):
         """Generate a summary of the mental state based on accumulated metrics"""
-        avg_alpha = np.mean(self.alpha_relaxation)
-        avg_beta = np.mean(self.beta_concentration)
-        avg_theta = np.mean(self.theta_relaxation)
-        avg_engagement = np.mean(self.engagement_index)
-        avg_arousal = np.mean(self.arousal_index)
-        avg_frustration = np.mean(self.frustration_index)
-        avg_mindfulness = np.mean(self.mindfulness_index)
+        avg_alpha, avg_beta, avg_theta, avg_engagement, avg_arousal, avg_frustration, avg_mindfulness = self.mean()
 
         # Determine overall mental state
         mental_state = {
@@ -53,14 +254,9 @@ class MetricsTracker:
         }
 
         return {
+            # nan (a metric without any finite value in the window) is not valid JSON, it becomes None
             "metrics": {
-                "alpha_relaxation": float(avg_alpha),
-                "beta_concentration": float(avg_beta),
-                "theta_relaxation": float(avg_theta),
-                "engagement_index": float(avg_engagement),
-                "arousal_index": float(avg_arousal),
-                "frustration_index": float(avg_frustration),
-                "mindfulness_index": float(avg_mindfulness),
+                name: value if math.isfinite(value) else None for name, value in zip(METRIC_NAMES, self.mean().tolist())
             },
             "mental_state": mental_state,
             "timestamp": time.time(),
@@ -0,0 +1,198 @@
+"""Recording and replay of EEG sessions
+
+A recording is a directory of .npy segments (samples and timestamps) with an
+index.json describing them:
+
+    index.json
+    data_00000.npy   float32 [n_samples, n_channels]
+    time_00000.npy   float64 [n_samples]
+    ...
+
+SessionRecorder appends the chunks pulled from an inlet, one segment file per
+"segment_samples" samples. ReplayInlet reads a recording back through
+memory-mapped segments, with the same pull_chunk API as pylsl's StreamInlet.
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+
+# Number of samples per segment file (one minute at 256 Hz)
+SEGMENT_SAMPLES = 256 * 60
+
+
+class SessionRecorder:
+    """Append raw EEG chunks and their timestamps to a recording directory.
+
+    Args:
+        path (str): recording directory, created if needed
+        fs (float): nominal sampling frequency of the stream
+        segment_samples (int): number of samples per segment file
+    """
+
+    def __init__(self, path, fs, segment_samples=SEGMENT_SAMPLES):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.segment_samples = segment_samples
+        self.index = {"fs": fs, "n_channels": None, "segments": []}
+        # Segment buffers, allocated on the first chunk for its number of channels
+        self.data = None
+        self.timestamps = np.zeros(segment_samples)
+        self.n_pending = 0
+
+    def record(self, eeg_data, timestamps):
+        """Append a chunk as returned by pull_chunk"""
+        eeg_data = np.asarray(eeg_data, dtype=np.float32)
+        timestamps = np.asarray(timestamps, dtype=float)
+        if self.data is None:
+            self.index["n_channels"] = eeg_data.shape[1]
+            self.data = np.zeros((self.segment_samples, eeg_data.shape[1]), dtype=np.float32)
+        start = 0
+        while start < len(eeg_data):
+            n_copy = min(len(eeg_data) - start, len(self.data) - self.n_pending)
+            self.data[self.n_pending : self.n_pending + n_copy] = eeg_data[start : start + n_copy]
+            self.timestamps[self.n_pending : self.n_pending + n_copy] = timestamps[start : start + n_copy]
+            self.n_pending += n_copy
+            start += n_copy
+            if self.n_pending == len(self.data):
+                self.flush()
+
+    def flush(self):
+        """Write the pending samples as a new segment and update the index"""
+        if self.n_pending == 0:
+            return
+        i_segment = len(self.index["segments"])
+        data_file = f"data_{i_segment:05d}.npy"
+        time_file = f"time_{i_segment:05d}.npy"
+        np.save(os.path.join(self.path, data_file), self.data[: self.n_pending])
+        np.save(os.path.join(self.path, time_file), self.timestamps[: self.n_pending])
+        self.index["segments"].append(
+            {
+                "data": data_file,
+                "time": time_file,
+                "n_samples": self.n_pending,
+                "start": float(self.timestamps[0]),
+                "end": float(self.timestamps[self.n_pending - 1]),
+            }
+        )
+        self.n_pending = 0
+
+        # Write the index atomically so a reader never sees a partial file
+        index_path = os.path.join(self.path, INDEX_FILE)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(index_path + ".tmp", index_path)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RecordingInlet:
+    """Wrap an inlet and record every chunk pulled from it"""
+
+    def __init__(self, inlet, recorder):
+        self.inlet = inlet
+        self.recorder = recorder
+
+    def pull_chunk(self, timeout=1, max_samples=256):
+        eeg_data, timestamps = self.inlet.pull_chunk(timeout=timeout, max_samples=max_samples)
+        if len(eeg_data):
+            self.recorder.record(eeg_data, timestamps)
+        return eeg_data, timestamps
+
+    def time_correction(self):
+        return self.inlet.time_correction()
+
+    def info(self):
+        return self.inlet.info()
+
+
+class ReplayInlet:
+    """Replay a recording with the pull_chunk API of StreamInlet.
+
+    Samples are returned as numpy arrays read from memory-mapped segments.
+
+    Args:
+        path (str): recording directory
+        speed (float): replay speed relative to real time (1 for real time,
+            N for N times faster), None to replay as fast as possible
+        loop (bool): start again from the beginning at the end of the recording
+    """
+
+    def __init__(self, path, speed=1.0, loop=False):
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.segments = [
+            (
+                np.load(os.path.join(path, segment["data"]), mmap_mode="r"),
+                np.load(os.path.join(path, segment["time"]), mmap_mode="r"),
+            )
+            for segment in self.index["segments"]
+        ]
+        self.fs = self.index["fs"]
+        self.speed = speed
+        self.loop = loop
+        self.i_segment = 0
+        self.position = 0
+        self.replay_start = None
+        self.first_timestamp = self.index["segments"][0]["start"] if self.segments else 0.0
+
+    def pull_chunk(self, timeout=1, max_samples=256):
+        """Return the next (at most "max_samples") samples and their timestamps
+
+        A chunk never spans two segments. At the end of the recording an empty
+        chunk is returned after "timeout", as StreamInlet does.
+        """
+        if self.i_segment >= len(self.segments):
+            if not self.loop or not self.segments:
+                time.sleep(timeout if self.speed else 0)
+                return np.zeros((0, self.index["n_channels"]), dtype=np.float32), np.zeros(0)
+            self.i_segment = 0
+            self.position = 0
+            self.replay_start = None
+
+        data, timestamps = self.segments[self.i_segment]
+        end = min(self.position + max_samples, len(data))
+        # Read-only views of the memory-mapped segment
+        chunk = data[self.position : end]
+        chunk_timestamps = timestamps[self.position : end]
+        self.position = end
+        if self.position == len(data):
+            self.i_segment += 1
+            self.position = 0
+
+        if self.speed:
+            # Wait until the last sample of the chunk is due
+            if self.replay_start is None:
+                self.replay_start = time.time() - (chunk_timestamps[0] - self.first_timestamp) / self.speed
+            delay = self.replay_start + (chunk_timestamps[-1] - self.first_timestamp) / self.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        return chunk, chunk_timestamps
+
+    def time_correction(self):
+        return 0.0
+
+    def info(self):
+        class Info:
+            def nominal_srate(self_inner):
+                return self.fs
+
+            def channel_count(self_inner):
+                return self.index["n_channels"]
+
+            def desc(self_inner):
+                return {}
+
+        return Info()
@@ -0,0 +1,212 @@
+"""Persistent store of the metrics and summaries of every session
+
+The metrics frames and summaries are appended to an SQLite database in WAL
+mode. Writes never happen on the DSP loop: add_metrics and add_summary only
+queue the rows, and a background writer thread inserts everything queued in
+one transaction every "commit_interval" seconds (group commit).
+
+Every run of the backend gets its own run id, so the sessions (headsets) of
+different runs are kept apart. Rows are indexed by (run, session, timestamp)
+and by (headset, timestamp).
+"""
+
+import contextlib
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from metrics_tracker import METRIC_NAMES
+
+# Seconds between two group commits of the writer thread
+COMMIT_INTERVAL = 1.0
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS metrics (
+    run TEXT NOT NULL,
+    session INTEGER NOT NULL,
+    headset TEXT,
+    timestamp REAL NOT NULL,
+    sample_timestamp REAL,
+    {", ".join(f"{name} REAL" for name in METRIC_NAMES)}
+);
+CREATE INDEX IF NOT EXISTS metrics_session ON metrics (run, session, timestamp);
+CREATE INDEX IF NOT EXISTS metrics_headset ON metrics (headset, timestamp);
+
+CREATE TABLE IF NOT EXISTS summaries (
+    run TEXT NOT NULL,
+    session INTEGER NOT NULL,
+    headset TEXT,
+    timestamp REAL NOT NULL,
+    summary TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS summaries_session ON summaries (run, session, timestamp);
+CREATE INDEX IF NOT EXISTS summaries_headset ON summaries (headset, timestamp);
+"""
+
+METRICS_COLUMNS = ("run", "session", "headset", "timestamp", "sample_timestamp") + METRIC_NAMES
+INSERT_METRICS = f"INSERT INTO metrics ({', '.join(METRICS_COLUMNS)}) VALUES ({', '.join('?' * len(METRICS_COLUMNS))})"
+INSERT_SUMMARY = "INSERT INTO summaries (run, session, headset, timestamp, summary) VALUES (?, ?, ?, ?, ?)"
+
+
+def _connect(path):
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    # In WAL mode a commit is durable up to the last checkpoint without a sync per commit
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class SessionStore:
+    """Append-only store of metrics frames and summaries, written by a background thread.
+
+    Args:
+        path (str): SQLite database file, created if needed
+        run (str): id of this run of the backend, by default its start time
+        commit_interval (float): seconds between two group commits
+    """
+
+    def __init__(self, path, run=None, commit_interval=COMMIT_INTERVAL):
+        self.path = path
+        self.run = run or time.strftime("%Y%m%d-%H%M%S")
+        self.commit_interval = commit_interval
+        self.pending = queue.SimpleQueue()
+        self.committed = 0
+        self.closed = threading.Event()
+
+        with contextlib.closing(_connect(path)) as connection:
+            connection.executescript(SCHEMA)
+            connection.commit()
+        self.writer = threading.Thread(target=self._write_forever, daemon=True)
+        self.writer.start()
+
+    def add_metrics(self, session, headset, metrics, timestamp, sample_timestamp=None):
+        """Queue a metrics vector (ordered as METRIC_NAMES, nan for invalid metrics)"""
+        values = [None if not np.isfinite(value) else value for value in np.asarray(metrics, dtype=float).tolist()]
+        self.pending.put((INSERT_METRICS, (self.run, session, headset, timestamp, sample_timestamp, *values)))
+
+    def add_summary(self, session, headset, summary, timestamp):
+        """Queue a summary (any JSON serializable dict)"""
+        self.pending.put((INSERT_SUMMARY, (self.run, session, headset, timestamp, json.dumps(summary))))
+
+    def _write_forever(self):
+        connection = _connect(self.path)
+        try:
+            while not self.closed.wait(self.commit_interval):
+                self._commit(connection)
+            self._commit(connection)
+        finally:
+            connection.close()
+
+    def _commit(self, connection):
+        """Insert every queued row in a single transaction"""
+        rows = {INSERT_METRICS: [], INSERT_SUMMARY: []}
+        while True:
+            try:
+                statement, row = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            rows[statement].append(row)
+        if not rows[INSERT_METRICS] and not rows[INSERT_SUMMARY]:
+            return
+        try:
+            with connection:
+                for statement, statement_rows in rows.items():
+                    connection.executemany(statement, statement_rows)
+        except sqlite3.Error as error:
+            # Keep the writer alive, only this batch is lost
+            print(f"Session store: failed to commit {sum(map(len, rows.values()))} rows: {error}")
+            return
+        self.committed += len(rows[INSERT_METRICS]) + len(rows[INSERT_SUMMARY])
+
+    def close(self):
+        """Commit the queued rows and stop the writer thread"""
+        self.closed.set()
+        self.writer.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_runs(self):
+        """Runs in the store, with their sessions and time span"""
+        with contextlib.closing(_connect(self.path)) as connection:
+            rows = connection.execute(
+                "SELECT run, session, headset, MIN(timestamp), MAX(timestamp), COUNT(*) FROM metrics"
+                " GROUP BY run, session ORDER BY run, session"
+            ).fetchall()
+        return [
+            {"run": run, "session": session, "headset": headset, "start": start, "end": end, "n_frames": count}
+            for run, session, headset, start, end, count in rows
+        ]
+
+    def get_history(self, run=None, session=None, headset=None, start=None, end=None, limit=None):
+        """Stored metrics frames, oldest first
+
+        Only committed frames are returned, i.e. up to "commit_interval" seconds old.
+
+        Args:
+            run (str): run id, None for the current run (or "*" for all runs)
+            session (int): session index, None for all sessions
+            headset (str): headset name, None for all headsets
+            start (float): oldest timestamp, None for no limit
+            end (float): newest timestamp, None for no limit
+            limit (int): maximum number of frames, the newest ones being kept
+
+        Returns:
+            (list): frames {"run", "session", "headset", "timestamp", "sample_timestamp", "metrics"}
+        """
+        return self._query("metrics", METRICS_COLUMNS, run, session, headset, start, end, limit, self._metrics_row)
+
+    def get_summaries(self, run=None, session=None, headset=None, start=None, end=None, limit=None):
+        """Stored summaries, oldest first (same arguments as get_history)"""
+        columns = ("run", "session", "headset", "timestamp", "summary")
+        return self._query("summaries", columns, run, session, headset, start, end, limit, self._summary_row)
+
+    def _query(self, table, columns, run, session, headset, start, end, limit, to_dict):
+        conditions = []
+        parameters = []
+        for condition, value in (
+            ("run = ?", self.run if run is None else None if run == "*" else run),
+            ("session = ?", session),
+            ("headset = ?", headset),
+            ("timestamp >= ?", start),
+            ("timestamp <= ?", end),
+        ):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+
+        query = f"SELECT {', '.join(columns)} FROM {table}"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY timestamp DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(int(limit))
+
+        with contextlib.closing(_connect(self.path)) as connection:
+            rows = connection.execute(query, parameters).fetchall()
+        return [to_dict(row) for row in reversed(rows)]
+
+    @staticmethod
+    def _metrics_row(row):
+        run, session, headset, timestamp, sample_timestamp = row[:5]
+        return {
+            "run": run,
+            "session": session,
+            "headset": headset,
+            "timestamp": timestamp,
+            "sample_timestamp": sample_timestamp,
+            "metrics": dict(zip(METRIC_NAMES, row[5:])),
+        }
+
+    @staticmethod
+    def _summary_row(row):
+        run, session, headset, timestamp, summary = row
+        return {"run": run, "session": session, "headset": headset, "timestamp": timestamp, **json.loads(summary)}
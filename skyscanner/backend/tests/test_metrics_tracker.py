@@ -0,0 +1,35 @@
+import json
+
+import numpy as np
+
+from metrics_tracker import METRIC_NAMES, MetricsTracker
+
+
+def test_window_statistics_skip_nan_rows():
+    tracker = MetricsTracker(max_size=5)
+    for value in (5, np.nan, 4, 6, 1):
+        tracker.add_metrics_vector([value] * len(METRIC_NAMES), timestamp=0)
+
+    np.testing.assert_allclose(tracker.mean(), 4)
+    np.testing.assert_allclose(tracker.variance(), 3.5)
+    np.testing.assert_array_equal(tracker.maximum(), 6)
+    np.testing.assert_array_equal(tracker.minimum(), 1)
+
+
+def test_summary_of_nan_rows_is_valid_json():
+    tracker = MetricsTracker(max_size=5)
+    tracker.add_metrics_vector(np.arange(len(METRIC_NAMES)), timestamp=0)
+    for _ in range(4):
+        tracker.add_metrics_vector([np.nan, np.inf] + [1] * (len(METRIC_NAMES) - 2), timestamp=0)
+
+    metrics = tracker.get_summary()["metrics"]
+    assert metrics["alpha_relaxation"] == 0
+    assert metrics["beta_concentration"] == 1
+    assert metrics["theta_relaxation"] == 1.2
+
+    # Once the finite row left the window, the first two metrics have no value
+    tracker.add_metrics_vector([np.nan, np.inf] + [1] * (len(METRIC_NAMES) - 2), timestamp=0)
+    metrics = tracker.get_summary()["metrics"]
+    assert metrics["alpha_relaxation"] is None
+    assert metrics["beta_concentration"] is None
+    json.dumps({"metrics": metrics, "horizons": tracker.get_horizon_summaries(timestamp=0)}, allow_nan=False)
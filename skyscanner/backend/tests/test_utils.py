@@ -0,0 +1,24 @@
+import numpy as np
+
+import utils
+
+
+def test_epoch_keeps_a_fractional_shift():
+    data = np.random.default_rng(0).standard_normal((1329, 2))
+    # 256 Hz with the epoch and overlap lengths of main.py: a fractional shift
+    epochs = utils.epoch(data, 256, 204.8)
+    shift = 256 - 204.8
+
+    assert epochs.shape == (256, 2, 21)
+    for i in range(epochs.shape[2]):
+        start = int(i * shift)
+        np.testing.assert_array_equal(epochs[:, :, i], data[start : start + 256])
+
+
+def test_epoch_with_a_whole_shift_is_a_view():
+    data = np.random.default_rng(0).standard_normal((1000, 2))
+    epochs = utils.epoch(data, 256, 128)
+
+    assert epochs.shape == (256, 2, 6)
+    assert np.shares_memory(epochs, data)
+    np.testing.assert_array_equal(epochs[:, :, 5], data[640:896])
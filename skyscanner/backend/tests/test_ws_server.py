@@ -0,0 +1,83 @@
+import asyncio
+from http import HTTPStatus
+from types import SimpleNamespace
+
+import pytest
+
+import ws_server
+from latency import LatencyStats
+
+
+class FakeStore:
+    run = "run"
+
+    def __init__(self):
+        self.kwargs = None
+
+    def get_history(self, **kwargs):
+        self.kwargs = kwargs
+        return []
+
+
+class FakeConnection:
+    def respond(self, status, text):
+        return SimpleNamespace(status=status, body=text, headers={"Content-Type": "text/plain"})
+
+
+def request_history(query):
+    store = FakeStore()
+    server = ws_server.WebSocketServer("localhost", 0, store=store)
+    request = SimpleNamespace(path=f"{ws_server.HISTORY_PATH}?{query}")
+    response = asyncio.run(server.process_request(FakeConnection(), request))
+    return response, store.kwargs
+
+
+@pytest.mark.parametrize(
+    ("query", "limit"),
+    [
+        ("", ws_server.HISTORY_LIMIT),
+        ("limit=10", 10),
+        (f"limit={ws_server.HISTORY_LIMIT + 1}", ws_server.HISTORY_LIMIT),
+    ],
+)
+def test_history_limit_is_capped(query, limit):
+    response, kwargs = request_history(query)
+    assert response.status == HTTPStatus.OK
+    assert kwargs["limit"] == limit
+
+
+@pytest.mark.parametrize("query", ["limit=-1", "limit=0", "limit=ten"])
+def test_invalid_history_limit_is_rejected(query):
+    response, kwargs = request_history(query)
+    assert response.status == HTTPStatus.BAD_REQUEST
+    assert kwargs is None
+
+
+class FakeClient:
+    format_key = (False, None)
+
+    def __init__(self):
+        self.messages = []
+
+    def wants(self, data):
+        return True
+
+    def encode(self, data):
+        return ws_server.wire_format.encode_json(data)
+
+    def offer(self, message):
+        self.messages.append(message)
+
+
+def test_end_to_end_latency_is_recorded_when_the_frame_is_queued():
+    latency = LatencyStats()
+    server = ws_server.WebSocketServer("localhost", 0, latency=latency, sample_clock=lambda: 10.5)
+    client = FakeClient()
+    server.clients.add(client)
+
+    server.queue_message({"type": "real_time", "session": 0, "metrics": {}, "sample_timestamp": 10.0})
+    server.queue_message({"type": "summary", "session": 0, "metrics": {}})
+
+    assert len(client.messages) == 2
+    assert latency.get_percentiles()["end_to_end"]["count"] == 1
+    assert latency.get_percentiles()["end_to_end"]["max"] == pytest.approx(500)
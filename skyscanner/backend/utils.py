@@ -7,10 +7,28 @@ epoching, and transforming EEG data into frequency bands
 @author: Cassani
 """
 
+import functools
+
 import numpy as np
-from scipy.signal import butter, lfilter, lfilter_zi
+from scipy.signal import butter, sosfilt, sosfilt_zi
+from scipy.signal.windows import dpss
+
+# Band stopped by the notch filter (in Hz), around the 60 Hz line noise
+NOTCH_BAND = (55, 65)
+
+# Welch segments: length (as a fraction of the epoch) and overlap (as a fraction of a segment)
+WELCH_SEGMENT_LENGTH = 0.5
+WELCH_OVERLAP = 0.5
 
-NOTCH_B, NOTCH_A = butter(4, np.array([55, 65]) / (256 / 2), btype="bandstop")
+# Multitaper: time-half-bandwidth product of the DPSS tapers, 2 * NW - 1 tapers are used
+MULTITAPER_NW = 2
+
+
+# Estimators of the spectrum the band powers are computed from
+class PSDMethod:
+    FFT = "fft"  # A single Hamming-windowed FFT of the epoch
+    Welch = "welch"  # Average over overlapping Hamming-windowed segments of the epoch
+    Multitaper = "multitaper"  # Average over DPSS tapers of the whole epoch
 
 
 def epoch(data, samples_epoch, samples_overlap=0):
@@ -19,6 +37,11 @@ def epoch(data, samples_epoch, samples_overlap=0):
     Given a 2D array of the shape [n_samples, n_channels]
     Creates a 3D array of the shape [wlength_samples, n_channels, n_epochs]
 
+    With a whole number of samples between epochs, the epochs are a read-only
+    strided view of "data" (no samples are copied), so consecutive overlapping
+    epochs share memory. A fractional shift is kept as is, the start of every
+    epoch being truncated to a sample, and the epochs are then copied.
+
     Args:
         data (numpy.ndarray or list of lists): data [n_samples, n_channels]
         samples_epoch (int): window length in samples
@@ -30,70 +53,159 @@ def epoch(data, samples_epoch, samples_overlap=0):
     if isinstance(data, list):
         data = np.array(data)
 
-    n_samples, n_channels = data.shape
-
+    samples_epoch = int(samples_epoch)
     samples_shift = samples_epoch - samples_overlap
 
-    n_epochs = int(np.floor((n_samples - samples_epoch) / float(samples_shift)) + 1)
-
-    # Markers indicate where the epoch starts, and the epoch contains samples_epoch rows
-    markers = np.asarray(range(0, n_epochs + 1)) * samples_shift
-    markers = markers.astype(int)
-
-    # Divide data in epochs
-    epochs = np.zeros((samples_epoch, n_channels, n_epochs))
+    # [n_windows, n_channels, samples_epoch], one window starting at every sample
+    windows = np.lib.stride_tricks.sliding_window_view(data, samples_epoch, axis=0)
+    if samples_shift == int(samples_shift):
+        epochs = windows[:: int(samples_shift)]
+    else:
+        n_epochs = int(np.floor((len(data) - samples_epoch) / samples_shift) + 1)
+        # Markers indicate where the epochs start
+        markers = (np.arange(n_epochs) * samples_shift).astype(int)
+        epochs = windows[markers]
 
-    for i in range(0, n_epochs):
-        epochs[:, :, i] = data[markers[i] : markers[i] + samples_epoch, :]
+    return epochs.transpose(2, 1, 0)
 
-    return epochs
 
-
-def compute_band_powers(eegdata, fs):
+def compute_band_powers(eegdata, fs, method=PSDMethod.FFT):
     """Extract the features (band powers) from the EEG.
 
     Args:
         eegdata (numpy.ndarray): array of dimension [number of samples,
                 number of channels]
         fs (float): sampling frequency of eegdata
+        method (str): spectrum estimator, see PSDMethod
 
     Returns:
         (numpy.ndarray): feature matrix of shape [number of feature points,
             number of different features]
     """
+    # [channels, bands] -> [bands, channels] so features are grouped by band
+    return compute_band_powers_batch(eegdata.T, fs, method).T.reshape(-1)
+
+
+def compute_band_powers_batch(epochs, fs, method=PSDMethod.FFT):
+    """Extract the band powers of a stack of epochs with a single FFT.
+
+    Welch and multitaper average the spectra of several windowed copies of
+    every epoch (segments or tapers), which all go through the same FFT call.
+    The average is taken over the squared amplitudes, and its square root is
+    rescaled to the single FFT estimate of a noise-like signal (see
+    SpectralPlan), so the methods agree on white noise.
+
+    Args:
+        epochs (numpy.ndarray): array of dimension [..., number of samples],
+            e.g. [sessions, channels, samples]
+        fs (float): sampling frequency of epochs
+        method (str): spectrum estimator, see PSDMethod
+
+    Returns:
+        (numpy.ndarray): log10 band powers of shape [..., 4], ordered
+            [delta, theta, alpha, beta]
+    """
+    plan = get_spectral_plan(epochs.shape[-1], fs, method)
+
     # 1. Compute the PSD
-    winSampleLength, nbCh = eegdata.shape
+    dataWinCentered = epochs - np.mean(epochs, axis=-1, keepdims=True)  # Remove offset
+    if method == PSDMethod.FFT:
+        dataWinCenteredHam = dataWinCentered * plan.window  # Apply Hamming window
+
+        Y = np.fft.rfft(dataWinCenteredHam, n=plan.nfft, axis=-1)
+        PSD = np.abs(Y[..., : plan.n_bins])
+    else:
+        # [..., n_segments, segment_length], a single segment for multitaper
+        segments = np.lib.stride_tricks.sliding_window_view(dataWinCentered, plan.segment_length, axis=-1)
+        segments = segments[..., :: plan.segment_shift, :]
+        # [..., n_segments, n_tapers, segment_length]
+        tapered = segments[..., np.newaxis, :] * plan.window
+
+        Y = np.fft.rfft(tapered, n=plan.nfft, axis=-1)[..., : plan.n_bins]
+        power = Y.real**2 + Y.imag**2
+        PSD = np.sqrt(power.mean(axis=(-3, -2)))
+
+    # 2. Average the PSD over the bins of each band
+    band_powers = PSD @ plan.band_matrix
 
-    # Apply Hamming window
-    w = np.hamming(winSampleLength)
-    dataWinCentered = eegdata - np.mean(eegdata, axis=0)  # Remove offset
-    dataWinCenteredHam = (dataWinCentered.T * w).T
+    return np.log10(band_powers)
 
-    NFFT = nextpow2(winSampleLength)
-    Y = np.fft.fft(dataWinCenteredHam, n=NFFT, axis=0) / winSampleLength
-    PSD = 2 * np.abs(Y[0 : int(NFFT / 2), :])
-    f = fs / 2 * np.linspace(0, 1, int(NFFT / 2))
 
-    # SPECTRAL FEATURES
-    # Average of band powers
-    # Delta <4
-    (ind_delta,) = np.where(f < 4)
-    meanDelta = np.mean(PSD[ind_delta, :], axis=0)
-    # Theta 4-8
-    (ind_theta,) = np.where((f >= 4) & (f <= 8))
-    meanTheta = np.mean(PSD[ind_theta, :], axis=0)
-    # Alpha 8-12
-    (ind_alpha,) = np.where((f >= 8) & (f <= 12))
-    meanAlpha = np.mean(PSD[ind_alpha, :], axis=0)
-    # Beta 12-30
-    (ind_beta,) = np.where((f >= 12) & (f < 30))
-    meanBeta = np.mean(PSD[ind_beta, :], axis=0)
+class SpectralPlan:
+    """Everything the band powers need that depends only on the epoch length,
+    the sampling frequency and the spectrum estimator: the window(s), the FFT
+    length and the band bins.
 
-    feature_vector = np.concatenate((meanDelta, meanTheta, meanAlpha, meanBeta), axis=0)
+    The band averaging (and the PSD scaling) is folded into "band_matrix" of
+    shape [n_bins, 4], so band powers are "abs(rfft(x))[..., :n_bins] @ band_matrix".
 
-    feature_vector = np.log10(feature_vector)
+    With PSDMethod.FFT "window" is the Hamming window of the epoch. Otherwise
+    it holds one window per taper, [n_tapers, segment_length]: one Hamming
+    window of the Welch segments, or the DPSS tapers of the epoch scaled to the
+    energy of its Hamming window.
 
-    return feature_vector
+    Args:
+        winSampleLength (int): epoch length in samples
+        fs (float): sampling frequency
+        method (str): spectrum estimator, see PSDMethod
+    """
+
+    def __init__(self, winSampleLength, fs, method=PSDMethod.FFT):
+        self.method = method
+        self.segment_length = winSampleLength
+        self.segment_shift = winSampleLength
+        if method == PSDMethod.FFT:
+            self.window = np.hamming(winSampleLength)
+        elif method == PSDMethod.Welch:
+            self.segment_length = max(int(winSampleLength * WELCH_SEGMENT_LENGTH), 1)
+            self.segment_shift = max(int(self.segment_length * (1 - WELCH_OVERLAP)), 1)
+            self.window = np.hamming(self.segment_length)[np.newaxis]
+        elif method == PSDMethod.Multitaper:
+            n_tapers = max(int(2 * MULTITAPER_NW) - 1, 1)
+            # dpss tapers have unit energy
+            hamming_energy = np.sum(np.hamming(winSampleLength) ** 2)
+            self.window = dpss(winSampleLength, MULTITAPER_NW, n_tapers).reshape(n_tapers, -1) * np.sqrt(hamming_energy)
+        else:
+            raise ValueError(f"Unknown PSD method {method!r}")
+
+        self.nfft = nextpow2(self.segment_length)
+        f = fs / 2 * np.linspace(0, 1, int(self.nfft / 2))
+
+        # SPECTRAL FEATURES
+        # Delta <4, Theta 4-8, Alpha 8-12, Beta 12-30
+        band_masks = (
+            f < 4,
+            (f >= 4) & (f <= 8),
+            (f >= 8) & (f <= 12),
+            (f >= 12) & (f < 30),
+        )
+        self.band_slices = []
+        for mask in band_masks:
+            (ind,) = np.where(mask)
+            self.band_slices.append(slice(ind[0], ind[-1] + 1) if len(ind) else slice(0, 0))
+
+        # Only the bins up to the end of the beta band are needed
+        self.n_bins = max(band.stop for band in self.band_slices)
+        scale = 2 / self.segment_length
+        if method != PSDMethod.FFT:
+            # On noise, the single FFT |Y| is Rayleigh distributed, of mean sqrt(pi / 4) * sqrt(E|Y|^2)
+            # while the averaged methods estimate sqrt(E|Y|^2). Its amplitude also grows with the square
+            # root of the segment length, so shorter Welch segments need sqrt(segment / epoch length)
+            scale *= np.sqrt(np.pi / 4 * self.segment_length / winSampleLength)
+        self.band_matrix = np.zeros((self.n_bins, len(band_masks)))
+        for i_band, band in enumerate(self.band_slices):
+            n_band_bins = band.stop - band.start
+            if n_band_bins == 0:
+                self.band_matrix[:, i_band] = np.nan  # Same as the mean of an empty band
+                continue
+            # PSD = 2 * |Y| / segment length, averaged over the band
+            self.band_matrix[band, i_band] = scale / n_band_bins
+
+
+@functools.lru_cache(maxsize=None)
+def get_spectral_plan(winSampleLength, fs, method=PSDMethod.FFT):
+    """Return the (cached) SpectralPlan for an epoch length, sampling frequency and spectrum estimator"""
+    return SpectralPlan(winSampleLength, fs, method)
 
 
 def nextpow2(i):
@@ -104,19 +216,22 @@ def nextpow2(i):
     return n
 
 
-def compute_feature_matrix(epochs, fs):
-    """Call compute_feature_vector for each EEG epoch"""
-    n_epochs = epochs.shape[2]
+def compute_feature_matrix(epochs, fs, method=PSDMethod.FFT):
+    """Compute the feature vector of every EEG epoch with a single FFT
 
-    for i_epoch in range(n_epochs):
-        if i_epoch == 0:
-            feat = compute_band_powers(epochs[:, :, i_epoch], fs).T
-            # Initialize feature_matrix
-            feature_matrix = np.zeros((n_epochs, feat.shape[0]))
+    Args:
+        epochs (numpy.ndarray): epoched data [wlength_samples, n_channels, n_epochs]
+        fs (float): sampling frequency
+        method (str): spectrum estimator, see PSDMethod
 
-        feature_matrix[i_epoch, :] = compute_band_powers(epochs[:, :, i_epoch], fs).T
+    Returns:
+        (numpy.ndarray): feature matrix of shape [n_epochs, n_features]
+    """
+    # [n_epochs, n_channels, 4] -> [n_epochs, 4, n_channels] so features are grouped by band
+    band_powers = compute_band_powers_batch(epochs.transpose(2, 1, 0), fs, method)
+    n_epochs = band_powers.shape[0]
 
-    return feature_matrix
+    return band_powers.transpose(0, 2, 1).reshape(n_epochs, -1)
 
 
 def get_feature_names(ch_names):
@@ -138,17 +253,27 @@ def get_feature_names(ch_names):
     return feat_names
 
 
-def update_buffer(data_buffer, new_data, notch=False, filter_state=None):
+def update_buffer(data_buffer, new_data, notch=False, filter_state=None, fs=256):
     """Concatenates "new_data" into "data_buffer", and returns an array with
     the same size as "data_buffer"
+
+    If "data_buffer" is a RingBuffer the samples are written in place and the
+    same buffer is returned, so no new array is allocated per chunk.
+
+    With "notch", "new_data" is filtered first. "filter_state" is the FilterBank
+    returned by the previous call (None to create a notch filter for "fs").
     """
     if new_data.ndim == 1:
         new_data = new_data.reshape(-1, data_buffer.shape[1])
 
     if notch:
         if filter_state is None:
-            filter_state = np.tile(lfilter_zi(NOTCH_B, NOTCH_A), (data_buffer.shape[1], 1)).T
-        new_data, filter_state = lfilter(NOTCH_B, NOTCH_A, new_data, axis=0, zi=filter_state)
+            filter_state = FilterBank(fs)
+        new_data = filter_state.filter(new_data)
+
+    if isinstance(data_buffer, RingBuffer):
+        data_buffer.append(new_data)
+        return data_buffer, filter_state
 
     new_buffer = np.concatenate((data_buffer, new_data), axis=0)
     new_buffer = new_buffer[new_data.shape[0] :, :]
@@ -160,6 +285,130 @@ def get_last_data(data_buffer, newest_samples):
     """Obtains from "buffer_array" the "newest samples" (N rows from the
     bottom of the buffer)
     """
+    if isinstance(data_buffer, RingBuffer):
+        return data_buffer.last(newest_samples)
+
     new_buffer = data_buffer[(data_buffer.shape[0] - newest_samples) :, :]
 
     return new_buffer
+
+
+class RingBuffer:
+    """Fixed-capacity buffer of the newest [n_samples, n_channels] rows.
+
+    Every row is written twice, once at the write cursor and once "capacity"
+    rows further, so the newest N rows are always one contiguous slice of the
+    backing array. This makes "last(n)" a zero-copy view even when the data
+    wraps around, and "append" costs O(chunk) with no allocation.
+
+    Views returned by "last" and "data" are only valid until the next append.
+
+    Args:
+        n_samples (int): number of rows kept in the buffer
+        n_channels (int): number of columns (channels or features)
+        dtype (numpy.dtype): dtype of the backing array
+        buffer (numpy.ndarray): zeroed backing array [2 * n_samples, n_channels]
+            to write into, e.g. a slice of an array shared by several buffers
+            (allocated by default)
+    """
+
+    def __init__(self, n_samples, n_channels, dtype=np.float64, buffer=None):
+        self.capacity = int(n_samples)
+        if buffer is None:
+            buffer = np.zeros((2 * self.capacity, n_channels), dtype=dtype)
+        self._data = buffer
+        self._cursor = 0
+
+    @property
+    def shape(self):
+        return (self.capacity, self._data.shape[1])
+
+    @property
+    def end(self):
+        """Row after the newest one in the backing array: "last(n)" is backing[end - n : end]"""
+        return self._cursor + self.capacity
+
+    @property
+    def data(self):
+        """Whole buffer, oldest row first (zero-copy view)"""
+        return self.last(self.capacity)
+
+    def append(self, new_data):
+        """Write "new_data" [n_new, n_channels] after the newest row"""
+        new_data = np.asarray(new_data)
+        if new_data.ndim == 1:
+            new_data = new_data.reshape(-1, self._data.shape[1])
+
+        n_new = new_data.shape[0]
+        if n_new >= self.capacity:
+            # Only the newest "capacity" rows survive
+            self._data[: self.capacity] = new_data[n_new - self.capacity :]
+            self._data[self.capacity :] = self._data[: self.capacity]
+            self._cursor = 0
+            return
+
+        end = self._cursor + n_new
+        if end <= self.capacity:
+            self._data[self._cursor : end] = new_data
+            self._data[self._cursor + self.capacity : end + self.capacity] = new_data
+        else:
+            first = self.capacity - self._cursor
+            self._data[self._cursor : self.capacity] = new_data[:first]
+            self._data[self._cursor + self.capacity :] = new_data[:first]
+            self._data[: end - self.capacity] = new_data[first:]
+            self._data[self.capacity : end] = new_data[first:]
+        self._cursor = end % self.capacity
+
+    def last(self, n):
+        """Newest "n" rows, oldest first (zero-copy view)"""
+        n = int(n)
+        if n > self.capacity:
+            raise ValueError(f"Requested {n} samples from a buffer of {self.capacity}")
+        end = self._cursor + self.capacity
+        return self._data[end - n : end]
+
+
+class FilterBank:
+    """Streaming filter applied to all channels of a stream in one call.
+
+    The stages are cascaded into a single array of second-order sections (more
+    stable than transfer function coefficients at high orders) and the state
+    of every section and channel is carried from one chunk to the next. The
+    state is created on the first chunk, for its number of channels.
+
+    Args:
+        fs (float): sampling frequency of the stream
+        notch_band (tuple): band (in Hz) of the band-stop filter, None for no notch
+        n_harmonics (int): number of harmonics of the notch band also stopped
+            (e.g. 120 and 180 Hz for 60 Hz line noise), if below Nyquist
+        highpass (float): cutoff (in Hz) of a high-pass stage, None for no high-pass
+        order (int): order of the Butterworth stages
+    """
+
+    def __init__(self, fs, notch_band=NOTCH_BAND, n_harmonics=0, highpass=None, order=4):
+        nyquist = fs / 2
+        stages = []
+        if highpass:
+            stages.append(butter(order, highpass / nyquist, btype="highpass", output="sos"))
+        if notch_band:
+            low, high = notch_band
+            center, half_width = (low + high) / 2, (high - low) / 2
+            for harmonic in range(1, n_harmonics + 2):
+                band = np.array([harmonic * center - half_width, harmonic * center + half_width])
+                if band[1] >= nyquist:
+                    break
+                stages.append(butter(order, band / nyquist, btype="bandstop", output="sos"))
+
+        self.fs = fs
+        self.sos = np.concatenate(stages) if stages else None
+        self.zi = None
+
+    def filter(self, data):
+        """Filter a chunk [n_samples, n_channels], continuing from the previous chunk"""
+        if self.sos is None:
+            return data
+        if self.zi is None:
+            # Steady state for a unit step, for every channel: [n_sections, 2, n_channels]
+            self.zi = np.repeat(sosfilt_zi(self.sos)[:, :, np.newaxis], data.shape[1], axis=2)
+        filtered, self.zi = sosfilt(self.sos, data, axis=0, zi=self.zi)
+        return filtered
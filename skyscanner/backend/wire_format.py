@@ -0,0 +1,147 @@
+"""Wire formats of the frames sent over the WebSocket
+
+Clients pick the format with the WebSocket subprotocol:
+
+- "eeg.json" (or no subprotocol): every frame is a JSON text message.
+- "eeg.binary.v2": real-time and summary metrics frames (with the horizon
+  means of summaries) are sent as compact binary messages, any other frame is
+  still sent as JSON text.
+
+Binary frame layout (little-endian):
+
+    magic        2 bytes   b"EG"
+    version      uint8     BINARY_VERSION
+    type         uint8     index in MESSAGE_TYPES
+    session      uint16
+    n_metrics    uint8
+    n_horizons   uint8     0 for real-time frames
+    timestamp    float64   seconds since the epoch
+    metrics      n_metrics x float32, ordered as METRIC_NAMES
+    counts       n_horizons x uint32, ordered as HORIZON_NAMES
+    horizons     n_horizons x n_metrics x float32, mean of every metric over each horizon
+
+Missing values (None in JSON frames) are sent as nan.
+
+The "headset" and "sample_timestamp" of a frame are not part of the binary
+layout, binary clients identify headsets by their session index.
+
+Batches of frames (see WebSocketServer subscriptions) are sent as one JSON
+message {"type": "batch", "frames": [...]}, or, for binary frames, as one
+binary message made of the frames back to back.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+from metrics_tracker import HORIZONS, METRIC_NAMES
+
+JSON_SUBPROTOCOL = "eeg.json"
+BINARY_SUBPROTOCOL = "eeg.binary.v2"
+SUBPROTOCOLS = [BINARY_SUBPROTOCOL, JSON_SUBPROTOCOL]
+
+BINARY_MAGIC = b"EG"
+BINARY_VERSION = 2
+MESSAGE_TYPES = ("real_time", "summary")
+HORIZON_NAMES = tuple(HORIZONS)
+
+HEADER = struct.Struct("<2sBBHBBd")
+METRICS_DTYPE = np.dtype("<f4")
+COUNTS_DTYPE = np.dtype("<u4")
+
+# Frames with other keys are sent as JSON even to binary clients
+BINARY_KEYS = frozenset({"type", "session", "headset", "metrics", "horizons", "timestamp", "sample_timestamp"})
+
+
+def encode_json(data):
+    """Encode a frame as a JSON text message"""
+    return json.dumps(data)
+
+
+def encode_json_batch(json_frames):
+    """Join already encoded JSON frames into a single batch message"""
+    return '{"type": "batch", "frames": [' + ", ".join(json_frames) + "]}"
+
+
+def encode_binary_batch(binary_frames):
+    """Join already encoded binary frames into a single batch message"""
+    return b"".join(binary_frames)
+
+
+def encode_binary(data):
+    """Encode a metrics frame as a binary message
+
+    Returns None if the frame cannot be represented in the binary format, in
+    which case it should be sent as JSON.
+    """
+    if data.get("type") not in MESSAGE_TYPES or set(data) - BINARY_KEYS:
+        return None
+    horizons = data.get("horizons", {})
+    if set(horizons) - set(HORIZON_NAMES):
+        return None
+    horizons = [horizons[name] for name in HORIZON_NAMES] if horizons else []
+
+    # None becomes nan
+    metrics = np.array([data["metrics"][name] for name in METRIC_NAMES], dtype=METRICS_DTYPE)
+    counts = np.array([horizon["count"] for horizon in horizons], dtype=COUNTS_DTYPE)
+    means = np.array([[horizon["metrics"][name] for name in METRIC_NAMES] for horizon in horizons], dtype=METRICS_DTYPE)
+    header = HEADER.pack(
+        BINARY_MAGIC,
+        BINARY_VERSION,
+        MESSAGE_TYPES.index(data["type"]),
+        data.get("session", 0),
+        len(metrics),
+        len(horizons),
+        data["timestamp"],
+    )
+    return header + metrics.tobytes() + counts.tobytes() + means.tobytes()
+
+
+def binary_size(n_metrics, n_horizons):
+    """Size in bytes of a binary frame"""
+    return (
+        HEADER.size
+        + n_metrics * METRICS_DTYPE.itemsize
+        + n_horizons * (COUNTS_DTYPE.itemsize + n_metrics * METRICS_DTYPE.itemsize)
+    )
+
+
+def decode_binary(message):
+    """Decode a binary metrics message back to a frame dict"""
+    magic, version, message_type, session, n_metrics, n_horizons, timestamp = HEADER.unpack_from(message)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError(f"Unsupported binary frame {magic!r} version {version}")
+
+    offset = HEADER.size
+    metrics = np.frombuffer(message, dtype=METRICS_DTYPE, count=n_metrics, offset=offset)
+    offset += metrics.nbytes
+    counts = np.frombuffer(message, dtype=COUNTS_DTYPE, count=n_horizons, offset=offset)
+    offset += counts.nbytes
+    means = np.frombuffer(message, dtype=METRICS_DTYPE, count=n_horizons * n_metrics, offset=offset)
+    frame = {
+        "type": MESSAGE_TYPES[message_type],
+        "session": session,
+        "metrics": dict(zip(METRIC_NAMES, metrics.tolist())),
+        "timestamp": timestamp,
+    }
+    if n_horizons:
+        frame["horizons"] = {
+            name: {"metrics": dict(zip(METRIC_NAMES, horizon_means)), "count": count}
+            for name, count, horizon_means in zip(
+                HORIZON_NAMES, counts.tolist(), means.reshape(n_horizons, n_metrics).tolist()
+            )
+        }
+    return frame
+
+
+def decode_binary_batch(message):
+    """Decode a binary message holding one or more frames"""
+    frames = []
+    offset = 0
+    while offset < len(message):
+        n_metrics, n_horizons = HEADER.unpack_from(message, offset)[4:6]
+        size = binary_size(n_metrics, n_horizons)
+        frames.append(decode_binary(message[offset : offset + size]))
+        offset += size
+    return frames
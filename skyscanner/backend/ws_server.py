@@ -1,61 +1,412 @@
 import asyncio
 import json
+import math
 import threading
+import time
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlparse
 
 import websockets
 
+import wire_format
+
+# Maximum number of messages waiting to be sent to a single client
+CLIENT_QUEUE_SIZE = 32
+
+# Maximum number of frames held for a single batch of a rate-limited client
+MAX_BATCH_SIZE = 1000
+
+# HTTP path answering the server and latency statistics as JSON, e.g. http://host:port/stats
+STATS_PATH = "/stats"
+
+# HTTP path answering the stored history of the sessions as JSON (see WebSocketServer.process_request)
+HISTORY_PATH = "/history"
+
+# Maximum number of (newest) frames answered by HISTORY_PATH, also its default "limit"
+HISTORY_LIMIT = 1000
+
+
+# What to do with a client that does not keep up with the stream
+class DropPolicy:
+    DropOldest = "drop_oldest"  # Drop the oldest queued message when the queue is full
+    Latest = "latest"  # Only keep the newest message, older ones are coalesced away
+    Disconnect = "disconnect"  # Close the connection when the queue is full
+
+
+class ClientConnection:
+    """A connected client and its bounded queue of outgoing messages.
+
+    Messages are sent by a dedicated task, so all clients are served
+    concurrently and a slow client never delays the others. "policy" decides
+    what happens when the client falls behind (see DropPolicy).
+
+    A client can also subscribe at a lower update rate: its frames are then held
+    and flushed "rate" times per second, either all of them in one batch
+    message or only the newest one (decimation).
+
+    By default a client receives every frame. It can narrow this down to some
+    topics: sessions, headsets, message types and metric names.
+    """
+
+    def __init__(self, websocket, max_queue=CLIENT_QUEUE_SIZE, policy=DropPolicy.DropOldest):
+        self.websocket = websocket
+        # Negotiated wire format (see wire_format)
+        self.binary = websocket.subprotocol == wire_format.BINARY_SUBPROTOCOL
+        self.policy = policy
+        self.queue = asyncio.Queue(maxsize=1 if policy == DropPolicy.Latest else max_queue)
+        self.sent = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.closing = False
+        # Update rate in Hz, None to send every frame as soon as it is computed
+        self.rate = None
+        self.batch = True
+        self.pending = []
+        self.flush_task = None
+        # Topics, None to receive everything
+        self.sessions = None
+        self.headsets = None
+        self.types = None
+        self.metrics = None
+
+    @property
+    def format_key(self):
+        """Clients with the same key receive the same encoding of a frame"""
+        # Binary frames have a fixed layout and always carry every metric
+        return (self.binary, None if self.binary else self.metrics)
+
+    def wants(self, data):
+        """Whether the frame matches the topics the client subscribed to"""
+        return (
+            (self.types is None or data.get("type") in self.types)
+            and (self.sessions is None or data.get("session") in self.sessions)
+            and (self.headsets is None or data.get("headset") in self.headsets)
+        )
+
+    def encode(self, data):
+        """Encode a frame in the wire format and with the metrics of the client"""
+        if self.binary:
+            binary_data = wire_format.encode_binary(data)
+            if binary_data is not None:
+                return binary_data
+        if self.metrics is not None and isinstance(data.get("metrics"), dict):
+            data = dict(data, metrics={name: data["metrics"][name] for name in self.metrics if name in data["metrics"]})
+        return wire_format.encode_json(data)
+
+    def set_topics(self, sessions=None, headsets=None, types=None, metrics=None):
+        """Restrict the frames sent to the client, None meaning no restriction"""
+        self.sessions = None if sessions is None else frozenset(sessions)
+        self.headsets = None if headsets is None else frozenset(headsets)
+        self.types = None if types is None else frozenset(types)
+        self.metrics = None if metrics is None else tuple(metrics)
+
+    def set_rate(self, rate, batch=True):
+        """Change the update rate (None for every frame) and batching of the client"""
+        self.flush()
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+
+        self.rate = rate if rate and rate > 0 else None
+        self.batch = batch
+        if self.rate:
+            self.flush_task = asyncio.ensure_future(self.flush_forever())
+
+    def offer(self, message):
+        """Send or hold an encoded frame, depending on the update rate of the client"""
+        if self.rate is None:
+            self.put(message)
+        elif self.batch:
+            if len(self.pending) >= MAX_BATCH_SIZE:
+                self.pending.pop(0)
+                self.dropped += 1
+            self.pending.append(message)
+        else:
+            self.dropped += len(self.pending)
+            self.pending = [message]
+
+    def flush(self):
+        """Queue the held frames, JSON and binary frames as one batch message each"""
+        if not self.pending:
+            return
+        if len(self.pending) == 1:
+            self.put(self.pending[0])
+        else:
+            json_frames = [message for message in self.pending if isinstance(message, str)]
+            binary_frames = [message for message in self.pending if isinstance(message, bytes)]
+            if json_frames:
+                self.put(wire_format.encode_json_batch(json_frames))
+            if binary_frames:
+                self.put(wire_format.encode_binary_batch(binary_frames))
+        self.pending = []
+
+    async def flush_forever(self):
+        while True:
+            await asyncio.sleep(1 / self.rate)
+            self.flush()
+
+    def handle_message(self, message):
+        """Handle a control message from the client
+
+        {"type": "subscribe", "rate": 10, "batch": true} sets the update rate in
+        Hz (0 or null for every frame) and whether held frames are batched or
+        decimated to the newest one.
+
+        {"type": "subscribe", "sessions": [0, 2], "headsets": ["muse-1"],
+        "types": ["real_time"], "metrics": ["alpha_relaxation"]} restricts the
+        frames to these topics. Any of them may be omitted or null for all.
+        Metric filtering only applies to JSON frames.
+
+        Invalid messages (not JSON, or with a mistyped value) are ignored.
+
+        Returns:
+            (bool): whether the topics of the client changed
+        """
+        try:
+            request = json.loads(message)
+        except (TypeError, ValueError):
+            return False
+        if not isinstance(request, dict) or request.get("type") != "subscribe":
+            return False
+        if "rate" in request or "batch" in request:
+            rate = request.get("rate")
+            # bool is an int, but not a rate
+            if rate is not None and (
+                isinstance(rate, bool) or not isinstance(rate, (int, float)) or not math.isfinite(rate)
+            ):
+                return False
+            self.set_rate(rate, bool(request.get("batch", True)))
+        topics = [request.get(topic) for topic in ("sessions", "headsets", "types", "metrics")]
+        if {"sessions", "headsets", "types", "metrics"} & set(request):
+            # Every topic is a list of values (a string would otherwise become a set of characters)
+            for values in topics:
+                if values is not None and (
+                    not isinstance(values, list) or not all(isinstance(value, (str, int, float)) for value in values)
+                ):
+                    return False
+            self.set_topics(*topics)
+            return True
+        return False
+
+    def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+
+    def put(self, message):
+        """Queue a message without waiting"""
+        if self.queue.full():
+            if self.policy == DropPolicy.Disconnect:
+                self.dropped += 1
+                if not self.closing:
+                    self.closing = True
+                    asyncio.ensure_future(self.websocket.close(code=1008, reason="Client too slow"))
+                return
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    async def send_forever(self):
+        """Send queued messages until the connection closes"""
+        try:
+            while True:
+                message = await self.queue.get()
+                await self.websocket.send(message)
+                self.sent += 1
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    def get_stats(self):
+        return {
+            "address": str(self.websocket.remote_address),
+            "policy": self.policy,
+            "binary": self.binary,
+            "rate": self.rate,
+            "sessions": None if self.sessions is None else sorted(self.sessions, key=str),
+            "types": None if self.types is None else sorted(self.types),
+            "pending": len(self.pending),
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+        }
+
 
 class WebSocketServer:
-    def __init__(self, host, port):
+    def __init__(
+        self,
+        host,
+        port,
+        client_queue_size=CLIENT_QUEUE_SIZE,
+        drop_policy=DropPolicy.DropOldest,
+        latency=None,
+        store=None,
+        sample_clock=None,
+    ):
         self.host = host
         self.port = port
+        self.client_queue_size = client_queue_size
+        self.drop_policy = drop_policy
+        # latency.LatencyStats recording the serialize, broadcast and end_to_end stages, None for none
+        self.latency = latency
+        # Clock of the "sample_timestamp" of the frames, for the end_to_end stage (None not to record it)
+        self.sample_clock = sample_clock
+        # session_store.SessionStore answering HISTORY_PATH, None for no history
+        self.store = store
         self.clients = set()
-        self.latest_data = None
+        # Counters of clients that already disconnected
+        self.closed_sent = 0
+        self.closed_dropped = 0
+        # Latest frame of each (type, session)
+        self.latest_data = {}
         self.server = None
         self.server_task = None
+        self.loop = None
 
     async def ws_handler(self, websocket):
         """Handle WebSocket connections"""
-        # Register client
-        self.clients.add(websocket)
+        # Register client, which may choose its own queue size, drop policy and
+        # update rate, e.g. ws://host:port/?policy=latest or ?policy=disconnect&queue=8&rate=1
+        query = parse_qs(urlparse(websocket.request.path).query)
+        policy = query.get("policy", [self.drop_policy])[0]
+        if policy not in (DropPolicy.DropOldest, DropPolicy.Latest, DropPolicy.Disconnect):
+            policy = self.drop_policy
+        queue_size = int(query["queue"][0]) if query.get("queue", [""])[0].isdigit() else self.client_queue_size
+        client = ClientConnection(websocket, max(queue_size, 1), policy)
+        rate = query.get("rate", [""])[0]
+        if rate.replace(".", "", 1).isdigit():
+            client.set_rate(float(rate))
+        self.clients.add(client)
+        sender_task = asyncio.create_task(client.send_forever())
         try:
             # If we have data already, send it immediately to the new client
-            if self.latest_data:
-                await websocket.send(self.latest_data)
+            self.send_latest(client)
 
-            # Keep connection alive and handle incoming messages if needed
+            # Keep connection alive and handle subscription messages
             async for message in websocket:
-                # Handle any client messages if necessary
-                pass
+                if client.handle_message(message):
+                    # Topics changed, send their latest data right away
+                    self.send_latest(client)
         except websockets.exceptions.ConnectionClosed:
             pass
         finally:
             # Unregister client
-            self.clients.remove(websocket)
+            self.clients.discard(client)
+            sender_task.cancel()
+            client.close()
+            self.closed_sent += client.sent
+            self.closed_dropped += client.dropped
 
-    async def broadcast(self, message):
-        """Broadcast message to all connected clients"""
-        if not self.clients:
-            return
+    def send_latest(self, client):
+        """Send the latest frame of every topic the client subscribed to"""
+        for data in list(self.latest_data.values()):
+            if client.wants(data):
+                client.offer(client.encode(data))
+
+    def queue_message(self, data, sent_at=None):
+        """Queue a frame for the clients subscribed to it (must run in the server loop)
 
+        The frame is encoded once per wire format and metric selection, and
+        only for the clients that want it.
+
+        Args:
+            data (dict): frame to send
+            sent_at (float): time.perf_counter() when the frame was handed over
+                by send_data, to time the broadcast stage
+        """
         # Store latest data
-        self.latest_data = message
+        self.latest_data[(data.get("type"), data.get("session"))] = data
 
-        # Send to all clients
-        disconnected_clients = set()
+        encoded = {}
+        serialize_time = 0
         for client in self.clients:
+            if not client.wants(data):
+                continue
+            key = client.format_key
+            if key not in encoded:
+                start = time.perf_counter()
+                encoded[key] = client.encode(data)
+                serialize_time += time.perf_counter() - start
+            client.offer(encoded[key])
+
+        if self.latency is not None and encoded:
+            self.latency.record("serialize", serialize_time)
+            if sent_at is not None:
+                self.latency.record("broadcast", time.perf_counter() - sent_at)
+            if self.sample_clock is not None and data.get("sample_timestamp") is not None:
+                self.latency.record("end_to_end", self.sample_clock() - data["sample_timestamp"])
+
+    def get_stats(self):
+        """Queue depth and dropped frames of every client (must run in the server loop)"""
+        clients = [client.get_stats() for client in self.clients]
+        return {
+            "clients": clients,
+            "queue_depth": sum(client["queue_depth"] for client in clients),
+            "sent": self.closed_sent + sum(client["sent"] for client in clients),
+            "dropped": self.closed_dropped + sum(client["dropped"] for client in clients),
+        }
+
+    async def process_request(self, connection, request):
+        """Answer HTTP requests to STATS_PATH and HISTORY_PATH, let WebSocket handshakes through
+
+        HISTORY_PATH takes the arguments of SessionStore.get_history as query
+        parameters, e.g. /history?session=0&start=1700000000&limit=100, and
+        type=summary for the summaries instead of the metrics frames. "limit"
+        must be positive and is capped to HISTORY_LIMIT, its default.
+        """
+        url = urlparse(request.path)
+        if url.path == STATS_PATH:
+            body = self.get_stats()
+            if self.latency is not None:
+                body["latency"] = self.latency.get_percentiles()
+        elif url.path == HISTORY_PATH and self.store is not None:
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
             try:
-                await client.send(message)
-            except websockets.exceptions.ConnectionClosed:
-                disconnected_clients.add(client)
+                kwargs = {
+                    "run": query.get("run"),
+                    "session": int(query["session"]) if "session" in query else None,
+                    "headset": query.get("headset"),
+                    "start": float(query["start"]) if "start" in query else None,
+                    "end": float(query["end"]) if "end" in query else None,
+                    "limit": min(int(query["limit"]), HISTORY_LIMIT) if "limit" in query else HISTORY_LIMIT,
+                }
+                if kwargs["limit"] < 1:
+                    raise ValueError("limit must be positive")
+            except ValueError:
+                return connection.respond(HTTPStatus.BAD_REQUEST, "Invalid history query\n")
+            get_history = self.store.get_summaries if query.get("type") == "summary" else self.store.get_history
+            # Reading the database must not block the server loop
+            body = {"run": self.store.run, "frames": await asyncio.to_thread(get_history, **kwargs)}
+        else:
+            return None
+
+        response = connection.respond(HTTPStatus.OK, json.dumps(body))
+        del response.headers["Content-Type"]
+        response.headers["Content-Type"] = "application/json"
+        # The frontend is served from another origin
+        response.headers["Access-Control-Allow-Origin"] = "*"
+        return response
 
-        # Remove disconnected clients
-        for client in disconnected_clients:
-            self.clients.remove(client)
+    async def broadcast(self, data):
+        """Broadcast a frame to all subscribed clients"""
+        self.queue_message(data)
+
+    def select_subprotocol(self, websocket, subprotocols):
+        """Pick the wire format offered by the client, JSON if it offers none we know"""
+        for subprotocol in wire_format.SUBPROTOCOLS:
+            if subprotocol in subprotocols:
+                return subprotocol
+        return None
 
     async def start_server(self):
         """Start the WebSocket server"""
-        self.server = await websockets.serve(self.ws_handler, self.host, self.port)
+        self.server = await websockets.serve(
+            self.ws_handler,
+            self.host,
+            self.port,
+            select_subprotocol=self.select_subprotocol,
+            process_request=self.process_request,
+        )
         print(f"WebSocket server started at ws://{self.host}:{self.port}")
         await self.server.wait_closed()
 
@@ -63,6 +414,7 @@ class WebSocketServer:
         """Run the server in a separate thread with its own event loop"""
         asyncio.set_event_loop(asyncio.new_event_loop())
         loop = asyncio.get_event_loop()
+        self.loop = loop
         self.server_task = loop.create_task(self.start_server())
         loop.run_forever()
 
@@ -73,6 +425,14 @@ class WebSocketServer:
         return thread
 
     def send_data(self, data):
-        """Send data to all clients"""
-        json_data = json.dumps(data)
-        asyncio.run(self.broadcast(json_data))
+        """Send data to all clients
+
+        Safe to call from any thread: the frame is handed over to the server
+        loop, which encodes it for the subscribed clients, and this call returns
+        without waiting for any client. "data" must not be modified afterwards.
+        """
+        if self.loop is None:
+            # Server not running yet, new clients will still get the latest data
+            self.latest_data[(data.get("type"), data.get("session"))] = data
+            return
+        self.loop.call_soon_threadsafe(self.queue_message, data, time.perf_counter())
@@ -1,14 +1,22 @@
 
 import { EEGMessage } from "../types";
+import { BINARY_SUBPROTOCOL, JSON_SUBPROTOCOL, decodeBinaryFrames, decodeJsonFrames } from "../utils/wireFormat";
 
 class WebSocketService {
   private socket: WebSocket | null = null;
   private callbacks: ((data: EEGMessage) => void)[] = [];
   private reconnectTimer: NodeJS.Timeout | null = null;
   private url: string;
+  private binary: boolean;
+  private rate: number | null;
+  private topics: { sessions?: number[]; headsets?: string[]; types?: string[]; metrics?: string[] } | null = null;
 
-  constructor(url: string) {
+  // With "binary", metrics frames are requested in the compact binary wire format.
+  // With "rate" (Hz), the server batches frames and sends them at that rate.
+  constructor(url: string, binary = false, rate: number | null = null) {
     this.url = url;
+    this.binary = binary;
+    this.rate = rate;
   }
 
   connect(): void {
@@ -18,10 +26,20 @@ class WebSocketService {
     }
 
     try {
-      this.socket = new WebSocket(this.url);
+      this.socket = this.binary
+        ? new WebSocket(this.url, [BINARY_SUBPROTOCOL, JSON_SUBPROTOCOL])
+        : new WebSocket(this.url);
+      this.socket.binaryType = "arraybuffer";
 
       this.socket.onopen = () => {
         console.log("WebSocket connected");
+        if (this.rate !== null) {
+          this.socket?.send(JSON.stringify({ type: "subscribe", rate: this.rate, batch: true }));
+        }
+        // Topics are per connection, replay them after a reconnect
+        if (this.topics !== null) {
+          this.socket?.send(JSON.stringify({ type: "subscribe", ...this.topics }));
+        }
         if (this.reconnectTimer) {
           clearTimeout(this.reconnectTimer);
           this.reconnectTimer = null;
@@ -30,8 +48,10 @@ class WebSocketService {
 
       this.socket.onmessage = (event) => {
         try {
-          const data = JSON.parse(event.data) as EEGMessage;
-          this.callbacks.forEach(callback => callback(data));
+          const frames = (
+            typeof event.data === "string" ? decodeJsonFrames(event.data) : decodeBinaryFrames(event.data)
+          ) as EEGMessage[];
+          frames.forEach(data => this.callbacks.forEach(callback => callback(data)));
         } catch (error) {
           console.error("Error parsing WebSocket message:", error);
         }
@@ -75,6 +95,28 @@ class WebSocketService {
     console.log("WebSocket disconnected");
   }
 
+  // Only receive some sessions, headsets, message types or metrics (omit a topic to receive all of it).
+  // Also sent when (re)connecting.
+  subscribe(topics: { sessions?: number[]; headsets?: string[]; types?: string[]; metrics?: string[] }): void {
+    this.topics = topics;
+    if (this.isConnected()) {
+      this.socket?.send(JSON.stringify({ type: "subscribe", ...topics }));
+    }
+  }
+
+  // Stored metrics frames (or summaries with type "summary") of the current run, served by the same backend over HTTP
+  async getHistory(
+    query: { session?: number; headset?: string; start?: number; end?: number; limit?: number; type?: "summary" } = {}
+  ): Promise<unknown[]> {
+    const url = new URL("/history", this.url.replace(/^ws/, "http"));
+    Object.entries(query).forEach(([key, value]) => url.searchParams.set(key, String(value)));
+    const response = await fetch(url);
+    if (!response.ok) {
+      throw new Error(`Failed to get history: ${response.statusText}`);
+    }
+    return (await response.json()).frames;
+  }
+
   onMessage(callback: (data: EEGMessage) => void): void {
     this.callbacks.push(callback);
   }
@@ -0,0 +1,90 @@
+import { EEGMetrics } from "../types";
+
+// Must match skyscanner/backend/wire_format.py
+export const JSON_SUBPROTOCOL = "eeg.json";
+export const BINARY_SUBPROTOCOL = "eeg.binary.v2";
+
+const BINARY_MAGIC = "EG";
+const BINARY_VERSION = 2;
+const HEADER_SIZE = 16;
+const MESSAGE_TYPES = ["real_time", "summary"] as const;
+const HORIZON_NAMES = ["5s", "1m", "session"];
+const METRIC_NAMES: (keyof EEGMetrics)[] = [
+  "alpha_relaxation",
+  "beta_concentration",
+  "theta_relaxation",
+  "engagement_index",
+  "arousal_index",
+  "frustration_index",
+  "mindfulness_index",
+];
+
+export interface MetricsFrame {
+  type: (typeof MESSAGE_TYPES)[number];
+  session: number;
+  metrics: EEGMetrics;
+  timestamp: number;
+  // Summary frames only: mean of every metric over each horizon
+  horizons?: Record<string, { metrics: EEGMetrics; count: number }>;
+}
+
+const frameSize = (nMetrics: number, nHorizons: number): number =>
+  HEADER_SIZE + 4 * nMetrics + nHorizons * (4 + 4 * nMetrics);
+
+const readMetrics = (view: DataView, offset: number, nMetrics: number): EEGMetrics => {
+  const metrics = {} as EEGMetrics;
+  for (let i = 0; i < Math.min(nMetrics, METRIC_NAMES.length); i++) {
+    metrics[METRIC_NAMES[i]] = view.getFloat32(offset + 4 * i, true);
+  }
+  return metrics;
+};
+
+export const decodeBinaryFrame = (buffer: ArrayBuffer, offset = 0): MetricsFrame => {
+  const view = new DataView(buffer, offset);
+  const magic = String.fromCharCode(view.getUint8(0), view.getUint8(1));
+  const version = view.getUint8(2);
+  if (magic !== BINARY_MAGIC || version !== BINARY_VERSION) {
+    throw new Error(`Unsupported binary frame ${magic} version ${version}`);
+  }
+
+  const nMetrics = view.getUint8(6);
+  const nHorizons = view.getUint8(7);
+  const frame: MetricsFrame = {
+    type: MESSAGE_TYPES[view.getUint8(3)],
+    session: view.getUint16(4, true),
+    metrics: readMetrics(view, HEADER_SIZE, nMetrics),
+    timestamp: view.getFloat64(8, true),
+  };
+
+  if (nHorizons > 0) {
+    // Counts of every horizon, then their means
+    const countsOffset = HEADER_SIZE + 4 * nMetrics;
+    const meansOffset = countsOffset + 4 * nHorizons;
+    frame.horizons = {};
+    for (let i = 0; i < Math.min(nHorizons, HORIZON_NAMES.length); i++) {
+      frame.horizons[HORIZON_NAMES[i]] = {
+        metrics: readMetrics(view, meansOffset + 4 * nMetrics * i, nMetrics),
+        count: view.getUint32(countsOffset + 4 * i, true),
+      };
+    }
+  }
+  return frame;
+};
+
+// A binary message holds one or more frames back to back
+export const decodeBinaryFrames = (buffer: ArrayBuffer): MetricsFrame[] => {
+  const frames: MetricsFrame[] = [];
+  let offset = 0;
+  while (offset < buffer.byteLength) {
+    const view = new DataView(buffer, offset);
+    frames.push(decodeBinaryFrame(buffer, offset));
+    offset += frameSize(view.getUint8(6), view.getUint8(7));
+  }
+  return frames;
+};
+
+// Unpack a JSON message, which may be a batch of frames
+export const decodeJsonFrames = (text: string): unknown[] => {
+  const message = JSON.parse(text);
+  return message.type === "batch" ? message.frames : [message];
+};